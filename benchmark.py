@@ -0,0 +1,723 @@
+# Copyright (c) Weasyl LLC
+# See COPYING for details.
+
+"""Benchmarks for elastirc's hot paths.
+
+Everything runs offline against synthetic data (or a recorded IRC stream).
+With `--json`, the results are also written out as JSON, along with the git
+commit they were measured at, so that runs can be compared between commits.
+"""
+
+from __future__ import division
+
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import elastirc
+
+from twisted.internet import defer, task
+from twisted.python.filepath import FilePath
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.test.requesthelper import DummyRequest
+from whoosh import index as whooshIndex
+
+
+class NullFactory(object):
+    "An ElastircFactory stand-in which throws away every document."
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.documents = 0
+
+    def logDocument(self, channel, document):
+        self.documents += 1
+
+
+def makeProtocol(channels, aggregateNetsplits=False, factory=None):
+    """Make an ElastircProtocol that's connected and signed on to `channels`.
+
+    If no `factory` is given, a NullFactory is used.
+    """
+
+    proto = elastirc.ElastircProtocol()
+    proto.factory = factory if factory is not None else NullFactory(channels)
+    proto.clock = task.Clock()
+    proto.aggregateNetsplits = aggregateNetsplits
+    proto.makeConnection(StringTransport())
+    proto.signedOn()
+    return proto
+
+
+def summarize(samples):
+    "Return the count, mean and percentiles of some latencies, in milliseconds."
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[min(int(len(samples) * p), len(samples) - 1)] * 1000
+
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples) * 1000,
+        'p50': percentile(0.5),
+        'p90': percentile(0.9),
+        'p99': percentile(0.99),
+        'p999': percentile(0.999),
+        'max': samples[-1] * 1000,
+    }
+
+
+def formatSummary(summary):
+    if not summary['count']:
+        return 'n=0'
+    return 'n=%(count)d mean=%(mean).3fms p50=%(p50).3fms p99=%(p99).3fms max=%(max).3fms' % summary
+
+
+def vocabulary(rng, size=5000):
+    "Make a list of `size` distinct made-up words."
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in xrange(rng.randint(2, 9))))
+    return sorted(words)
+
+
+def pickWord(rng, words):
+    "Pick a word with a roughly Zipfian distribution, so some are very common."
+    return words[int(len(words) * rng.random() ** 4)]
+
+
+def sentence(rng, words):
+    return ' '.join(pickWord(rng, words) for _ in xrange(rng.randint(2, 15)))
+
+
+def syntheticStream(rng, channels, users, events, splitEvery=0, splitSize=0.2):
+    """Make a list of raw IRC lines like a server would send the bot.
+
+    `users` users talk, act, join, part, change nick, set modes and quit in
+    `channels` for `events` events. Every `splitEvery` events, if that's
+    nonzero, `splitSize` of the users online split and then rejoin.
+    """
+
+    words = vocabulary(rng)
+    members = dict((channel, []) for channel in channels)
+    joined = {}
+    offline = ['user%d' % (i,) for i in xrange(users)]
+    lines = []
+
+    def join(nick, channel):
+        members[channel].append(nick)
+        joined.setdefault(nick, set()).add(channel)
+        lines.append(':%s!user@host JOIN %s' % (nick, channel))
+
+    def leave(nick, channel):
+        members[channel].remove(nick)
+        joined[nick].discard(channel)
+
+    def quit(nick, reason):
+        for channel in joined.pop(nick):
+            members[channel].remove(nick)
+        lines.append(':%s!user@host QUIT :%s' % (nick, reason))
+
+    def someone(channel):
+        if not members[channel] or (offline and rng.random() < 0.01):
+            if not offline:
+                return rng.choice(joined.keys())
+            nick = offline.pop(rng.randrange(len(offline)))
+            join(nick, channel)
+            return nick
+        return rng.choice(members[channel])
+
+    for n in xrange(events):
+        if splitEvery and n and not n % splitEvery:
+            splitters = rng.sample(sorted(joined), int(len(joined) * splitSize))
+            rejoins = [(nick, sorted(joined[nick])) for nick in splitters]
+            for nick in splitters:
+                quit(nick, 'hub.example.net leaf.example.net')
+            for nick, nickChannels in rejoins:
+                for channel in nickChannels:
+                    join(nick, channel)
+            continue
+        channel = rng.choice(channels)
+        nick = someone(channel)
+        roll = rng.random()
+        if roll < 0.70:
+            lines.append(':%s!user@host PRIVMSG %s :%s' % (nick, channel, sentence(rng, words)))
+        elif roll < 0.75:
+            lines.append(':%s!user@host PRIVMSG %s :\x01ACTION %s\x01' % (
+                nick, channel, sentence(rng, words)))
+        elif roll < 0.85:
+            others = [c for c in channels if c not in joined.get(nick, ())]
+            if others:
+                join(nick, rng.choice(others))
+        elif roll < 0.90 and channel in joined.get(nick, ()):
+            leave(nick, channel)
+            lines.append(':%s!user@host PART %s :%s' % (nick, channel, sentence(rng, words)))
+        elif roll < 0.93:
+            newNick = nick[:-1] if nick.endswith('_') else nick + '_'
+            if newNick not in joined:
+                for c in joined[nick]:
+                    members[c][members[c].index(nick)] = newNick
+                joined[newNick] = joined.pop(nick)
+                lines.append(':%s!user@host NICK %s' % (nick, newNick))
+        elif roll < 0.95:
+            lines.append(':%s!user@host MODE %s +o %s' % (nick, channel, someone(channel)))
+        else:
+            quit(nick, sentence(rng, words))
+            offline.append(nick)
+    return lines
+
+
+def benchNetsplit(args):
+    """Replay a synthetic netsplit.
+
+    `--users` users are spread over `--channels` channels, each joining
+    `--channels-per-user` of them; then `--split` of the users quit with a
+    netsplit reason, and the rest of them change nick. With `--aggregate`,
+    netsplit aggregation is turned on.
+    """
+
+    rng = random.Random(args.seed)
+    channels = ['#channel%d' % (i,) for i in xrange(args.channels)]
+    proto = makeProtocol(channels, args.aggregate)
+    nicks = ['user%d' % (i,) for i in xrange(args.users)]
+    for nick in nicks:
+        for channel in rng.sample(channels, args.channels_per_user):
+            proto.irc_RPL_NAMREPLY('server', ['elastirc', '=', channel, '@' + nick])
+    rng.shuffle(nicks)
+    quitters, renamers = nicks[:args.split], nicks[args.split:]
+
+    started = time.time()
+    for nick in quitters:
+        proto.userQuit('%s!user@host' % (nick,), 'irc.example.net hub.example.net')
+    proto.clock.advance(proto.netsplitWindow)
+    quitTime = time.time() - started
+    quitDocuments = proto.factory.documents
+
+    started = time.time()
+    for nick in renamers:
+        proto.userRenamed(nick, nick + '_')
+    renameTime = time.time() - started
+
+    print 'netsplit: %d quits in %.3fs (%.0f/s) making %d documents' % (
+        len(quitters), quitTime, len(quitters) / quitTime, quitDocuments)
+    print 'netsplit: %d renames in %.3fs (%.0f/s)' % (
+        len(renamers), renameTime, len(renamers) / renameTime)
+    return {
+        'quits': len(quitters),
+        'quitsPerSecond': len(quitters) / quitTime,
+        'quitDocuments': quitDocuments,
+        'renames': len(renamers),
+        'renamesPerSecond': len(renamers) / renameTime,
+    }
+
+
+legacyCruftRegexp = re.compile('\x03[0-9]{1,2}(?:,[0-9]{1,2})?|[\x00-\x08\x0A-\x1F]')
+
+def legacySanitizeDocument(document):
+    "Sanitize a document the way logDocument did before sanitizeDocument."
+    for k, v in document.iteritems():
+        document[k] = legacyCruftRegexp.sub('', v).decode('utf-8', 'replace')
+    return document['formatted'].encode('utf-8')
+
+
+def chatMessages(rng, count, formattedShare):
+    """Make `count` realistic chat messages as raw bytes.
+
+    About `formattedShare` of them have mIRC colors, bold or underlining,
+    and some have non-ASCII text or invalid UTF-8.
+    """
+
+    words = vocabulary(rng)
+    extras = [u'caf\xe9', u'\u2603', u'na\xefve', u'\U0001f408', u'\u65e5\u672c']
+    ret = []
+    for n in xrange(count):
+        parts = sentence(rng, words).split()
+        if rng.random() < 0.1:
+            parts.insert(rng.randrange(len(parts) + 1), rng.choice(extras).encode('utf-8'))
+        if rng.random() < 0.005:
+            parts.append('\xff\xfe')
+        if rng.random() < formattedShare:
+            for i in rng.sample(xrange(len(parts)), max(1, len(parts) // 3)):
+                code = rng.choice(['\x02', '\x1f', '\x0f', '\x03%d' % (rng.randrange(16),),
+                                   '\x03%02d,%d' % (rng.randrange(16), rng.randrange(16))])
+                parts[i] = code + parts[i] + rng.choice(['\x03', '\x0f', ''])
+        ret.append(' '.join(parts))
+    return ret
+
+
+def benchSanitize(args):
+    """Time sanitizing the documents made by chat messages.
+
+    `--messages` PRIVMSG documents are sanitized by sanitizeDocument, as
+    logDocument does, and by the regex-and-decode of every value it replaced.
+    About `--formatted` of the messages have mIRC formatting in them.
+    """
+
+    rng = random.Random(args.seed)
+    nicks = ['user%d' % (i,) for i in xrange(args.users)]
+    documents = []
+    for message in chatMessages(rng, args.messages, args.formatted):
+        nick = pickWord(rng, nicks)
+        documents.append(
+            {'actor': nick, 'message': message, 'formatted': '<%s> %s' % (nick, message)})
+
+    results = {}
+    for name, sanitize in [('legacy', legacySanitizeDocument),
+                           ('current', elastirc.sanitizeDocument)]:
+        batch = [dict(document) for document in documents]
+        started = time.time()
+        for document in batch:
+            sanitize(document)
+        elapsed = time.time() - started
+        results[name] = {
+            'seconds': elapsed,
+            'messagesPerSecond': len(batch) / elapsed,
+            'microsecondsPerMessage': elapsed / len(batch) * 1000000,
+        }
+        print 'sanitize: %s: %d messages in %.3fs (%.2fus each)' % (
+            name, len(batch), elapsed, results[name]['microsecondsPerMessage'])
+    return results
+
+
+class TimedLogFile(elastirc.DatestampedLogFile):
+    "A DatestampedLogFile which records how long each write and flush takes."
+
+    writeTimes = flushTimes = None
+
+    def write(self, data, when=None):
+        started = time.time()
+        ret = elastirc.DatestampedLogFile.write(self, data, when)
+        self.writeTimes.append(time.time() - started)
+        return ret
+
+    def flush(self):
+        started = time.time()
+        elastirc.DatestampedLogFile.flush(self)
+        self.flushTimes.append(time.time() - started)
+
+
+class TimedWriter(object):
+    "Wraps an index writer, recording how long each `add_document` takes."
+
+    def __init__(self, writer, times):
+        self.writer = writer
+        self.times = times
+
+    @property
+    def queueDepth(self):
+        return getattr(self.writer, 'queueDepth', 0)
+
+    def add_document(self, **fields):
+        started = time.time()
+        ret = self.writer.add_document(**fields)
+        self.times.append(time.time() - started)
+        return ret
+
+
+class NullWriter(object):
+    def add_document(self, **fields):
+        pass
+
+
+class PassThroughGate(elastirc.IngestGate):
+    "An IngestGate which passes every document straight on to the writer."
+
+    def _overRate(self, channel):
+        return False
+
+    def _queueDepth(self):
+        return 0
+
+
+@defer.inlineCallbacks
+def benchReplay(args):
+    """Replay an IRC stream through the bot, logging and indexing it.
+
+    The stream is either raw IRC lines recorded from a server, read from
+    `--input`, or a synthetic one of `--events` events from `--users` users
+    in `--channels` channels, with a netsplit every `--split-every` events.
+    Each line is fed to a real ElastircProtocol and ElastircFactory, which
+    write plaintext logs and index into a scratch directory (unless
+    `--no-index` is given). The stream's clock advances `--interval` seconds
+    per line.
+
+    Documents go straight on to be indexed, so that results can be compared
+    with those from before there was an IngestGate, unless `--ingest-gate`
+    is given; then a real IngestGate meters them by the stream's clock, and
+    whatever it deferred is flushed before the final commit.
+    """
+
+    rng = random.Random(args.seed)
+    if args.input:
+        with open(args.input) as infile:
+            lines = [line.rstrip('\r\n') for line in infile]
+        channels = sorted(set(
+            word for line in lines for word in line.split()[2:3] if word[:1] in '#&'))
+    else:
+        channels = ['#channel%d' % (i,) for i in xrange(args.channels)]
+        lines = syntheticStream(rng, channels, args.users, args.events, args.split_every)
+
+    scratch = tempfile.mkdtemp(prefix='elastirc-bench-')
+    times = dict((k, []) for k in ['event', 'logDocument', 'write', 'flush', 'indexAdd'])
+
+    class LogFile(TimedLogFile):
+        writeTimes = times['write']
+        flushTimes = times['flush']
+
+    class Factory(elastirc.ElastircFactory):
+        logFactory = LogFile
+        ingestFactory = elastirc.IngestGate if args.ingest_gate else PassThroughGate
+
+        def logDocument(self, channel, document):
+            started = time.time()
+            elastirc.ElastircFactory.logDocument(self, channel, document)
+            times['logDocument'].append(time.time() - started)
+
+    Factory.channels = channels
+    pipeline = None
+    if args.no_index:
+        writer = NullWriter()
+    else:
+        class Pipeline(elastirc.IndexingPipeline):
+            maxQueued = args.max_queued
+        os.makedirs(os.path.join(scratch, 'index'))
+        pipeline = Pipeline(whooshIndex.create_in(os.path.join(scratch, 'index'), elastirc.whooshSchema))
+        pipeline.start()
+        writer = pipeline
+    factory = Factory(FilePath(scratch).child('logs'), TimedWriter(writer, times['indexAdd']))
+    proto = makeProtocol(channels, args.aggregate, factory)
+    factory.ingest.clock = proto.clock
+
+    try:
+        started = time.time()
+        for line in lines:
+            lineStarted = time.time()
+            proto.dataReceived(line + '\r\n')
+            times['event'].append(time.time() - lineStarted)
+            proto.clock.advance(args.interval)
+        proto.clock.advance(proto.netjoinWindow)
+        factory.flushLogs()
+        replayTime = time.time() - started
+        gate = factory.ingest
+        results = {
+            'events': len(lines),
+            'documents': len(times['logDocument']),
+            'replaySeconds': replayTime,
+            'eventsPerSecond': len(lines) / replayTime,
+            'documentsPerSecond': len(times['logDocument']) / replayTime,
+            'ingest': {
+                'admitted': sum(gate.admitted.itervalues()),
+                'deferred': sum(gate.deferrals.itervalues()),
+                'shed': sum(gate.shed.itervalues()),
+            },
+        }
+        # The stream's clock stops with the stream, so anything still
+        # deferred is flushed by the real one.
+        from twisted.internet import reactor
+        gate.clock = reactor
+        yield gate.flush()
+        if pipeline is not None:
+            yield pipeline.commit()
+            indexTime = time.time() - started
+            results.update({
+                'indexed': pipeline.indexed,
+                'dropped': pipeline.dropped,
+                'indexSeconds': indexTime,
+                'indexedPerSecond': pipeline.indexed / indexTime,
+                'commits': pipeline.commits,
+            })
+        results['latency'] = dict((k, summarize(v)) for k, v in times.iteritems())
+    finally:
+        if pipeline is not None:
+            yield pipeline.stop()
+        shutil.rmtree(scratch)
+
+    print 'replay: %(events)d events making %(documents)d documents in %(replaySeconds).3fs' % results
+    print 'replay: %(eventsPerSecond).0f events/s, %(documentsPerSecond).0f documents/s' % results
+    print 'replay: %(admitted)d admitted, %(deferred)d deferred, %(shed)d shed by the ingest gate' % (
+        results['ingest'])
+    if pipeline is not None:
+        print ('replay: %(indexed)d indexed (%(dropped)d dropped) in %(indexSeconds).3fs, '
+               '%(indexedPerSecond).0f/s' % results)
+    for k, v in sorted(results['latency'].iteritems()):
+        print 'replay: %s latency: %s' % (k, formatSummary(v))
+    defer.returnValue(results)
+
+
+def syntheticDocuments(rng, count, channels, users, start, span):
+    """Make `count` documents like the bot would index, spread over `span`."""
+    words = vocabulary(rng)
+    nicks = ['user%d' % (i,) for i in xrange(users)]
+    step = span.total_seconds() / count
+    for n in xrange(count):
+        nick = pickWord(rng, nicks)
+        message = sentence(rng, words).decode()
+        yield {
+            'formatted': u'<%s> %s' % (nick, message),
+            'message': message,
+            'actor': nick.decode(),
+            'channel': rng.choice(channels).decode(),
+            'receivedAt': start + datetime.timedelta(seconds=n * step),
+        }
+
+
+def openBenchmarkIndex(path, documents, args):
+    """Open the synthetic index of `documents` documents at `path`.
+
+    The index is built first if it doesn't exist yet; building the larger
+    ones takes a while, so they're kept around to be reused by later runs.
+    """
+
+    if whooshIndex.exists_in(path):
+        ix = whooshIndex.open_dir(path)
+        if ix.doc_count() == documents:
+            elastirc.upgradeIndexSchema(ix)
+            return ix
+        ix.close()
+        shutil.rmtree(path)
+    os.makedirs(path)
+    ix = whooshIndex.create_in(path, elastirc.whooshSchema)
+    print 'search: building an index of %d documents in %s' % (documents, path)
+    started = time.time()
+    rng = random.Random(args.seed)
+    writer = ix.writer(procs=args.procs, limitmb=256, multisegment=args.procs > 1)
+    channels = [channel.lstrip('#') for channel in searchChannels(args)]
+    for document in syntheticDocuments(
+            rng, documents, channels, args.users, datetime.datetime(2020, 1, 1),
+            datetime.timedelta(days=args.days)):
+        writer.add_document(**document)
+    writer.commit()
+    print 'search: built in %.1fs' % (time.time() - started,)
+    return ix
+
+
+def searchChannels(args):
+    return ['#channel%d' % (i,) for i in xrange(args.channels)]
+
+
+def queryMix(rng, args):
+    """Make a list of (kind, request args) of searches to run.
+
+    There's a mix of searches by actor, common and rare words, phrases,
+    date ranges, single channels and following pages.
+    """
+
+    words = vocabulary(random.Random(args.seed))
+    channels = [channel.lstrip('#') for channel in searchChannels(args)]
+    kinds = ['actor', 'commonWord', 'rareWord', 'phrase', 'actorAndWord', 'dateRange', 'channel',
+             'nextPage']
+    ret = []
+    for n in xrange(args.queries):
+        kind = kinds[n % len(kinds)]
+        common = words[rng.randrange(10)]
+        if kind == 'actor':
+            queryArgs = {'actor': ['user%d' % (rng.randrange(50),)]}
+        elif kind == 'commonWord' or kind == 'nextPage':
+            queryArgs = {'formatted': [common]}
+        elif kind == 'rareWord':
+            queryArgs = {'formatted': [words[rng.randrange(len(words) // 2, len(words))]]}
+        elif kind == 'phrase':
+            queryArgs = {'formatted': ['"%s %s"' % (common, words[rng.randrange(10)])]}
+        elif kind == 'actorAndWord':
+            queryArgs = {'actor': ['user%d' % (rng.randrange(50),)], 'formatted': [common]}
+        elif kind == 'dateRange':
+            since = datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randrange(args.days))
+            queryArgs = {
+                'formatted': [common],
+                'since': [since.strftime('%Y-%m-%d')],
+                'until': [(since + datetime.timedelta(days=7)).strftime('%Y-%m-%d')],
+            }
+        elif kind == 'channel':
+            queryArgs = {'formatted': [common], 'channel': [rng.choice(channels)]}
+        ret.append((kind, queryArgs))
+    return ret
+
+
+nextPageArgRegexp = re.compile(r'<input type="hidden" name="(after|skip)" value="([^"]*)"')
+
+def renderSearch(resource, queryArgs):
+    """Render a search, returning a Deferred firing with the request.
+
+    The request's `latency` attribute is how long the search took.
+    """
+
+    request = DummyRequest([''])
+    request.method = 'POST'
+    request.args = dict((k, list(v)) for k, v in queryArgs.iteritems())
+    started = time.time()
+    resource.render(request)
+
+    def finished(ignored):
+        request.latency = time.time() - started
+        return request
+
+    if request.finished:
+        return defer.succeed(finished(None))
+    return request.notifyFinish().addCallback(finished)
+
+
+@defer.inlineCallbacks
+def runSearch(resource, kind, queryArgs, times, errors):
+    request = yield renderSearch(resource, queryArgs)
+    if kind == 'nextPage' and request.responseCode is None:
+        pageArgs = dict(
+            (k, [v]) for k, v in nextPageArgRegexp.findall(''.join(request.written)))
+        if pageArgs:
+            queryArgs = dict(queryArgs, **pageArgs)
+            request = yield renderSearch(resource, queryArgs)
+    if request.responseCode not in (None, 200):
+        errors[request.responseCode] = errors.get(request.responseCode, 0) + 1
+    else:
+        times[kind].append(request.latency)
+
+
+@defer.inlineCallbacks
+def benchSearch(args):
+    """Run a mix of searches against indexes of synthetic documents.
+
+    For each of `--documents`, an index of that many documents is built in
+    `--index-dir` (or reused, if one's already there), and `--queries`
+    searches are made through ElastircSearchResource, `--concurrency` at a
+    time. The search result cache is off unless `--cache` is given.
+    """
+
+    channels = searchChannels(args)
+    results = {}
+    for documents in args.documents:
+        ix = openBenchmarkIndex(
+            os.path.join(args.index_dir, str(documents)), documents, args)
+        pipeline = elastirc.IndexingPipeline(ix)
+
+        class Factory(elastirc.ElastircFactory):
+            searchConcurrency = args.search_threads
+            searchCacheBytes = 16 * 1024 * 1024 if args.cache else 0
+
+        Factory.channels = channels
+        factory = Factory(FilePath(tempfile.mkdtemp(prefix='elastirc-bench-')), pipeline)
+        resource = factory.buildWebResource(channels).children['']
+        mix = queryMix(random.Random(args.seed), args)
+        times = dict((kind, []) for kind, _ in mix)
+        errors = {}
+        semaphore = defer.DeferredSemaphore(args.concurrency)
+        started = time.time()
+        yield defer.gatherResults([
+            semaphore.run(runSearch, resource, kind, queryArgs, times, errors)
+            for kind, queryArgs in mix])
+        elapsed = time.time() - started
+        factory.searchPool.stop()
+        yield pipeline.stop()
+        shutil.rmtree(factory.logDir.path)
+
+        allTimes = [t for kindTimes in times.itervalues() for t in kindTimes]
+        results[str(documents)] = {
+            'queries': len(mix),
+            'seconds': elapsed,
+            'queriesPerSecond': len(mix) / elapsed,
+            'errors': dict((str(k), v) for k, v in errors.iteritems()),
+            'latency': summarize(allTimes),
+            'latencyByKind': dict((k, summarize(v)) for k, v in times.iteritems()),
+        }
+        print 'search: %d documents: %d queries in %.3fs (%.1f/s), errors %r' % (
+            documents, len(mix), elapsed, len(mix) / elapsed, errors)
+        for kind, summary in sorted(results[str(documents)]['latencyByKind'].iteritems()):
+            print 'search: %d documents: %s: %s' % (documents, kind, formatSummary(summary))
+    defer.returnValue(results)
+
+
+def gitCommit():
+    "Return the git commit of the working tree, or None if it's not known."
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    startedAt = datetime.datetime.utcnow()
+    results = yield defer.maybeDeferred(args.bench, args)
+    if args.json is None:
+        return
+    output = {
+        'benchmark': args.bench.__name__,
+        'commit': gitCommit(),
+        'python': sys.version.split()[0],
+        'startedAt': startedAt.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'args': dict((k, v) for k, v in vars(args).iteritems() if k not in ('bench', 'json')),
+        'results': results,
+    }
+    with open(args.json, 'w') as outfile:
+        json.dump(output, outfile, indent=2, sort_keys=True)
+        outfile.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--json', metavar='PATH', help='also write the results as JSON to PATH')
+    subparsers = parser.add_subparsers()
+
+    netsplit = subparsers.add_parser('netsplit', help=benchNetsplit.__doc__.splitlines()[0])
+    netsplit.add_argument('--channels', default=500, type=int)
+    netsplit.add_argument('--users', default=20000, type=int)
+    netsplit.add_argument('--channels-per-user', default=3, type=int)
+    netsplit.add_argument('--split', default=10000, type=int)
+    netsplit.add_argument('--seed', default=0, type=int)
+    netsplit.add_argument('--aggregate', default=False, action='store_true')
+    netsplit.set_defaults(bench=benchNetsplit)
+
+    sanitize = subparsers.add_parser('sanitize', help=benchSanitize.__doc__.splitlines()[0])
+    sanitize.add_argument('--messages', default=500000, type=int)
+    sanitize.add_argument('--users', default=2000, type=int)
+    sanitize.add_argument('--formatted', default=0.05, type=float)
+    sanitize.add_argument('--seed', default=0, type=int)
+    sanitize.set_defaults(bench=benchSanitize)
+
+    replay = subparsers.add_parser('replay', help=benchReplay.__doc__.splitlines()[0])
+    replay.add_argument('--input', metavar='FILE', help='a file of raw IRC lines to replay')
+    replay.add_argument('--channels', default=20, type=int)
+    replay.add_argument('--users', default=2000, type=int)
+    replay.add_argument('--events', default=200000, type=int)
+    replay.add_argument('--split-every', default=50000, type=int)
+    replay.add_argument('--interval', default=0.001, type=float)
+    replay.add_argument('--max-queued', default=10000, type=int)
+    replay.add_argument('--no-index', default=False, action='store_true')
+    replay.add_argument('--seed', default=0, type=int)
+    replay.add_argument('--aggregate', default=False, action='store_true')
+    replay.add_argument('--ingest-gate', default=False, action='store_true')
+    replay.set_defaults(bench=benchReplay)
+
+    search = subparsers.add_parser('search', help=benchSearch.__doc__.splitlines()[0])
+    search.add_argument(
+        '--documents', default=[1000000, 10000000], type=int, nargs='+', metavar='N')
+    search.add_argument('--index-dir', default='benchmark-indexes')
+    search.add_argument('--channels', default=20, type=int)
+    search.add_argument('--users', default=5000, type=int)
+    search.add_argument('--days', default=365, type=int)
+    search.add_argument('--procs', default=1, type=int)
+    search.add_argument('--queries', default=400, type=int)
+    search.add_argument('--concurrency', default=4, type=int)
+    search.add_argument('--search-threads', default=4, type=int)
+    search.add_argument('--cache', default=False, action='store_true')
+    search.add_argument('--seed', default=0, type=int)
+    search.set_defaults(bench=benchSearch)
+
+    args = parser.parse_args()
+    task.react(run, [args])
+
+
+if __name__ == '__main__':
+    main()
@@ -4,49 +4,981 @@
 from __future__ import division
 
 from twisted.cred.portal import IRealm
-from twisted.internet import protocol
-from twisted.python.filepath import FilePath
+from twisted.internet import defer, protocol, threads
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log, threadable
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath, InsecurePath
 from twisted.python.logfile import BaseLogFile
-from twisted.web.resource import Resource, ForbiddenResource, IResource
-from twisted.web import template, static
+from twisted.python.threadpool import ThreadPool
+from twisted.web.resource import Resource, ForbiddenResource, IResource, NoResource
+from twisted.web import http, server, template, static
 from twisted.words.protocols import irc
 
 from zope.interface import implementer
 import whoosh.fields
-from whoosh.qparser import QueryParser
-from whoosh import query
+from whoosh.qparser import MultifieldParser, QueryParser
+from whoosh import index as whooshIndex, query
 
 import collections
+import contextlib
+import bisect
+import cProfile
 import datetime
-import operator
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import os.path
+import pstats
+import Queue
 import re
+import shutil
+import StringIO
+import struct
+import sys
+import threading
+import time
+import traceback
+import urllib
 
 
-ircFormattingCruftRegexp = re.compile('\x03[0-9]{1,2}(?:,[0-9]{1,2})?|[\x00-\x08\x0A-\x1F]')
+ircColorRegexp = re.compile('\x03[0-9]{1,2}(?:,[0-9]{1,2})?')
+ircControlCharacters = ''.join(chr(c) for c in xrange(0x20) if c != 0x09)
+
+def sanitizeMessage(message):
+    """Strip IRC formatting from a byte string and decode it as UTF-8.
+
+    Returns a tuple of the message as unicode and as valid UTF-8. Invalid
+    UTF-8 is replaced, so the second is only re-encoded when there was any.
+    """
+
+    if '\x03' in message:
+        message = ircColorRegexp.sub('', message)
+    message = message.translate(None, ircControlCharacters)
+    try:
+        return message.decode('utf-8'), message
+    except UnicodeDecodeError:
+        decoded = message.decode('utf-8', 'replace')
+        return decoded, decoded.encode('utf-8')
+
 def fixupMessage(message):
-    return ircFormattingCruftRegexp.sub('', message).decode('utf-8', 'replace')
+    return sanitizeMessage(message)[0]
+
+def sanitizeDocument(document):
+    """Sanitize every value of a document in place, as with sanitizeMessage.
+
+    Returns the sanitized `formatted` value as UTF-8. Values which are the
+    same are only sanitized once, and if `formatted` ends with a space and
+    then another value, as it usually does, only the part before that value
+    is sanitized again.
+    """
+
+    sanitized = {}
+    formatted = document.pop('formatted')
+    for k, v in document.iteritems():
+        if v not in sanitized:
+            sanitized[v] = sanitizeMessage(v)
+        document[k] = sanitized[v][0]
+    for v, (decoded, encoded) in sanitized.iteritems():
+        if v and formatted.endswith(v) and formatted[-len(v) - 1:-len(v)] == ' ':
+            prefixDecoded, prefixEncoded = sanitizeMessage(formatted[:-len(v)])
+            document['formatted'] = prefixDecoded + decoded
+            return prefixEncoded + encoded
+    document['formatted'], encoded = sanitizeMessage(formatted)
+    return encoded
 
 DATE_FORMAT = '%F'
 TIME_FORMAT = '%T'
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
 def unprefixedChannel(channel):
     return channel.lstrip('#&')
 
 
-whooshSchema = whoosh.fields.Schema(
-    formatted=whoosh.fields.TEXT(stored=True),
-    receivedAt=whoosh.fields.DATETIME(stored=True),
-    channel=whoosh.fields.ID(stored=True),
-    actor=whoosh.fields.ID(),
+def makeWhooshSchema(slim=False):
+    """Make the schema for an index of logs.
+
+    Every document stores where its line starts in its log file as
+    `logOffset`. A slim index doesn't also store the line itself as
+    `formatted`; it's read back from the logs instead, with fillFromLogs.
+    """
+
+    return whoosh.fields.Schema(
+        formatted=whoosh.fields.TEXT(stored=not slim),
+        receivedAt=whoosh.fields.DATETIME(stored=True),
+        channel=whoosh.fields.ID(stored=True),
+        logOffset=whoosh.fields.NUMERIC(bits=64, stored=True),
+        actor=whoosh.fields.ID(),
+
+        message=whoosh.fields.TEXT(),
+        topic=whoosh.fields.TEXT(),
+        reason=whoosh.fields.TEXT(),
+        oldName=whoosh.fields.ID(),
+        kicker=whoosh.fields.ID(),
+        nicks=whoosh.fields.KEYWORD(),
+    )
+
+whooshSchema = makeWhooshSchema()
+slimWhooshSchema = makeWhooshSchema(slim=True)
+
+def upgradeIndexSchema(index, schema=whooshSchema):
+    """Add any fields from `schema` which an existing index is missing.
+
+    Indexes created before a field was added to the schema can't have
+    documents with that field added to them until this is done.
+    """
 
-    message=whoosh.fields.TEXT(),
-    topic=whoosh.fields.TEXT(),
-    reason=whoosh.fields.TEXT(),
-    oldName=whoosh.fields.ID(),
-    kicker=whoosh.fields.ID(),
+    missing = [name for name in schema.names() if name not in index.schema]
+    if not missing:
+        return
+    writer = index.writer()
+    for name in missing:
+        writer.add_field(name, schema[name])
+    writer.commit()
+
+
+logLineRegexp = re.compile(
+    r'(?P<time>[0-9:]{8}) (?P<formatted>'
+      r'\(-\) netsplit (?P<netsplit>quits|rejoins) \((?P<split>[^)]*)\): (?P<nicks>.*)'
+      r'|\(-\) (?P<actor>[^ ]+?) '
+        r'(?P<action>joined|parted|quit'
+        r'|was kicked by (?P<kicker>[^ ]+?)'
+        r'|changed nick from (?P<oldName>[^ ]+?)'
+        r'|changed topic to (?P<topic>.*)'
+        r'|set mode .+)'
+        r'(?: \((?P<reason>.*)\))?'
+      r'|<(?P<message_actor>[^>]+?)> (?P<message>.*)'
+      r'|\* (?P<emote_actor>[^ ]+?) (?P<emote>.*)'
+    r')'
 )
 
+def parseLogLine(line, channel, day):
+    """Turn a line of a plaintext log back into the document it was made from.
+
+    `line` is a unicode line from the log of `channel` for the date `day`.
+    Returns None if the line isn't in a recognized format.
+    """
+
+    match = logLineRegexp.match(line)
+    if match is None:
+        return None
+    groups = match.groupdict()
+    if groups['netsplit']:
+        doc = {'nicks': groups['nicks'], 'reason': groups['split']}
+    elif groups['message_actor']:
+        doc = {'actor': groups['message_actor'], 'message': groups['message']}
+    elif groups['emote_actor']:
+        doc = {'actor': groups['emote_actor'], 'message': groups['emote']}
+    else:
+        doc = {}
+        for key in ['actor', 'kicker', 'oldName', 'topic', 'reason']:
+            if groups[key]:
+                doc[key] = groups[key]
+    doc['formatted'] = groups['formatted']
+    doc['channel'] = channel
+    time = groups['time']
+    doc['receivedAt'] = datetime.datetime(
+        day.year, day.month, day.day, int(time[0:2]), int(time[3:5]), int(time[6:8]))
+    return doc
+
+compressedLogSuffix = '.gz'
+
+def uncompressedLogName(name):
+    "Return the name a log file had before it was compressed."
+    if name.endswith(compressedLogSuffix):
+        name = name[:-len(compressedLogSuffix)]
+    return name
+
+
+def logFileName(channel, day):
+    "Return the name of a channel's log file for a day; see splitLogFileName."
+    return '%s.%s' % (channel.encode('utf-8'), day.strftime(DATE_FORMAT))
+
+
+def splitLogFileName(name):
+    """Split a log file's name into its unicode channel and its date.
+
+    Compressed log files' names are split like those of the files they were
+    compressed from. Returns None if the name doesn't look like one of our
+    log files.
+    """
+
+    channel, _, day = uncompressedLogName(name).rpartition('.')
+    try:
+        day = datetime.datetime.strptime(day, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+    return channel.decode('utf-8'), day
+
+
+def openLogFile(path):
+    "Open a log file for reading, decompressing it if it's compressed."
+    if path.endswith(compressedLogSuffix):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def logFileSize(path):
+    """Return the size of a log file, as it was before any compression.
+
+    The size of a compressed log is read from the end of the gzip file, so
+    it's wrong for logs of 4GiB or more.
+    """
+
+    if not path.endswith(compressedLogSuffix):
+        return os.path.getsize(path)
+    with open(path, 'rb') as infile:
+        infile.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', infile.read(4))[0]
+
+
+def fillFromLogs(logDir, hits):
+    """Fill in the `formatted` of hits from a slim index from the logs.
+
+    `logDir` is the FilePath of the log directory. Each hit's line is read
+    from its `logOffset` in the log for its channel and date. The hits from
+    each log file are read in order of offset, so each file is opened once
+    and read front to back. Hits which already have a `formatted` are left
+    alone, and any whose lines can't be read get an empty one.
+    """
+
+    byLogFile = collections.defaultdict(list)
+    for hit in hits:
+        if 'formatted' in hit:
+            continue
+        hit['formatted'] = u''
+        if hit.get('logOffset') is not None:
+            byLogFile[hit['channel'], hit['receivedAt'].date()].append(hit)
+    for (channel, day), logHits in byLogFile.iteritems():
+        channel = channel.encode('utf-8')
+        try:
+            logPath = logDir.child(channel).child(
+                '%s.%s' % (channel, day.strftime(DATE_FORMAT)))
+        except InsecurePath:
+            continue
+        if not logPath.exists():
+            logPath = logPath.siblingExtension(compressedLogSuffix)
+        logHits.sort(key=lambda hit: hit['logOffset'])
+        try:
+            with openLogFile(logPath.path) as infile:
+                for hit in logHits:
+                    if infile.tell() != hit['logOffset']:
+                        infile.seek(hit['logOffset'])
+                    line = infile.readline()
+                    if line.endswith('\n'):
+                        hit['formatted'] = line[9:-1].decode('utf-8', 'replace')
+        except (IOError, OSError):
+            log.err(None, 'error while reading %s' % (logPath.path,))
+
+
+class Histogram(object):
+    """Counts observations of a value, such as a latency, in buckets.
+
+    `buckets` are the upper bounds of the buckets, in ascending order; there's
+    always one more bucket for anything larger. Observing a value is a bisect
+    and two additions, so it's cheap enough to do for every message.
+    """
+
+    defaultBuckets = (
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=defaultBuckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+def _formatMetricValue(value):
+    if value is None:
+        return 'NaN'
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _formatMetricLabels(labels):
+    return ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for k, v in labels)
+
+
+def formatMetrics(sources):
+    """Format the metrics of some objects in the Prometheus text format.
+
+    Each source has a `metrics` method returning (name, type, help, value)
+    tuples, where the type is 'counter', 'gauge' or 'histogram'. A value is a
+    number, a Histogram, or a dict mapping tuples of (label, value) pairs to
+    numbers.
+    """
+
+    lines = []
+    for source in sources:
+        for name, kind, help, value in source.metrics():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if isinstance(value, Histogram):
+                cumulative = 0
+                for bound, count in zip(value.buckets + (float('inf'),), value.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%s"} %d' % (
+                        name, _formatMetricValue(bound), cumulative))
+                lines.append('%s_sum %s' % (name, _formatMetricValue(value.sum)))
+                lines.append('%s_count %d' % (name, cumulative))
+            elif isinstance(value, dict):
+                for labels, v in sorted(value.iteritems()):
+                    lines.append('%s{%s} %s' % (
+                        name, _formatMetricLabels(labels), _formatMetricValue(v)))
+            else:
+                lines.append('%s %s' % (name, _formatMetricValue(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class ReactorWatchdog(object):
+    """Measures how late the reactor runs things, and catches it stalling.
+
+    A probe is scheduled with `callLater` every `interval` seconds, and how
+    late each one runs is observed in the `lag` Histogram. A thread of its
+    own checks on the probe just as often; if none has run for `threshold`
+    seconds, the reactor thread is stuck in something, and the stack of
+    whatever that is gets logged (once per stall) and kept as `lastStall`.
+    """
+
+    interval = 0.1
+    threshold = 1.0
+
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.lag = Histogram()
+        self.stalls = 0
+        self.lastStall = None
+        self._reactorThread = None
+        self._thread = None
+        self._delayedProbe = None
+        self._lastProbe = self._reportedProbe = None
+
+    def start(self):
+        """Start probing, and stop at shutdown.
+
+        This must be called from the reactor thread.
+        """
+
+        if self._thread is not None:
+            return
+        self._reactorThread = threading.current_thread().ident
+        self._lastProbe = time.time()
+        self._delayedProbe = self.reactor.callLater(self.interval, self._probe)
+        self._thread = threading.Thread(target=self._watch, name='elastirc-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._thread = None
+        if self._delayedProbe is not None and self._delayedProbe.active():
+            self._delayedProbe.cancel()
+        self._delayedProbe = None
+
+    def _probe(self):
+        now = time.time()
+        self.lag.observe(max(now - self._lastProbe - self.interval, 0))
+        self._lastProbe = now
+        self._delayedProbe = self.reactor.callLater(self.interval, self._probe)
+
+    def _watch(self):
+        thread = self._thread
+        while self._thread is thread:
+            time.sleep(self.interval)
+            lastProbe = self._lastProbe
+            if time.time() - lastProbe < self.threshold or lastProbe == self._reportedProbe:
+                continue
+            self._reportedProbe = lastProbe
+            frame = sys._current_frames().get(self._reactorThread)
+            if frame is None:
+                continue
+            self.stalls += 1
+            self.lastStall = ''.join(traceback.format_stack(frame))
+            log.msg('reactor stalled for over %.1fs in:\n%s' % (
+                time.time() - lastProbe, self.lastStall))
+
+    def metrics(self):
+        "Return metrics about the reactor's lag; see formatMetrics."
+        return [
+            ('elastirc_reactor_lag_seconds', 'histogram',
+             'How late the reactor ran a call scheduled for a fixed time.', self.lag),
+            ('elastirc_reactor_stalls_total', 'counter',
+             'Times the reactor went over the stall threshold without running anything.',
+             self.stalls),
+        ]
+
+
+def sampleStacks(threadIdent, seconds, interval=0.005):
+    """Sample the stack of a thread every `interval` seconds for a while.
+
+    This blocks for `seconds`, so it must be called from some other thread
+    than the one sampled. Returns the number of samples and two Counters of
+    the (filename, first line, function name) of functions: one of how many
+    samples each was running in, and one of how many each was on the stack
+    for.
+    """
+
+    own = collections.Counter()
+    inclusive = collections.Counter()
+    samples = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        frame = sys._current_frames().get(threadIdent)
+        if frame is not None:
+            samples += 1
+            seen = set()
+            own[_frameFunction(frame)] += 1
+            while frame is not None:
+                function = _frameFunction(frame)
+                if function not in seen:
+                    seen.add(function)
+                    inclusive[function] += 1
+                frame = frame.f_back
+            del frame
+        time.sleep(interval)
+    return samples, own, inclusive
+
+
+def _frameFunction(frame):
+    code = frame.f_code
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def formatStackSamples(samples, own, inclusive, limit=50):
+    "Format the result of sampleStacks as a table of the hottest functions."
+    if not samples:
+        return 'No samples were taken.\n'
+    lines = ['%d samples' % (samples,), '', '   own%   total%  function']
+    for function, count in own.most_common(limit):
+        filename, firstLine, name = function
+        lines.append('%6.1f   %6.1f  %s (%s:%d)' % (
+            count * 100 / samples, inclusive[function] * 100 / samples, name, filename, firstLine))
+    lines.extend(['', '   total%  function'])
+    for function, count in inclusive.most_common(limit):
+        filename, firstLine, name = function
+        lines.append('%8.1f  %s (%s:%d)' % (count * 100 / samples, name, filename, firstLine))
+    return '\n'.join(lines) + '\n'
+
+
+class ImportManifest(object):
+    """A record of how much of each log file has been committed to an index.
+
+    This maps log file names to the number of bytes from the start of the file
+    whose lines are in the index, and is stored as JSON at `path`. It's only
+    ever replaced atomically, so it never claims more than was committed.
+
+    It can also note the offsets of lines before that which are missing from
+    the index after all, such as those the live writer dropped; a file with
+    any is stored as an [offset, [missing offsets]] pair.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+        self.missing = {}
+        if path.exists():
+            for name, offset in json.loads(path.getContent()).iteritems():
+                if isinstance(offset, list):
+                    offset, missing = offset
+                    self.missing[name] = set(missing)
+                self.offsets[name] = offset
+
+    def _key(self, name):
+        if isinstance(name, str):
+            name = name.decode('utf-8')
+        return name
+
+    def get(self, name):
+        return self.offsets.get(self._key(name), 0)
+
+    def set(self, name, offset):
+        self.offsets[self._key(name)] = offset
+
+    def addMissing(self, name, offsets):
+        "Note the offsets of lines of a log file which aren't in the index."
+        self.missing.setdefault(self._key(name), set()).update(offsets)
+
+    def removeMissing(self, name, offsets):
+        "Note that some lines noted as missing are in the index now."
+        key = self._key(name)
+        missing = self.missing.get(key)
+        if missing is None:
+            return
+        missing.difference_update(offsets)
+        if not missing:
+            del self.missing[key]
+
+    def missingOffsets(self):
+        "Return a dict mapping log file names to sorted lists of missing offsets."
+        return dict((name, sorted(offsets)) for name, offsets in self.missing.iteritems())
+
+    def save(self):
+        stored = dict(self.offsets)
+        for name, missing in self.missing.iteritems():
+            stored[name] = [self.offsets.get(name, 0), sorted(missing)]
+        self.path.setContent(json.dumps(stored, sort_keys=True))
+
+
+class LogSyncer(object):
+    """Index the lines appended to the plaintext logs since the last sync.
+
+    `logDir` is the FilePath of the log directory, laid out as ElastircFactory
+    writes it, and `manifest` is the ImportManifest recording how much of
+    each log file is already in the index that `writer` adds to. Each sync
+    reads only the bytes past the recorded offsets, so catching up after an
+    outage costs time in proportion to what was missed.
+
+    If the logs are also being indexed live in this process, `liveRanges`
+    should be a callable returning the ranges of bytes written live, like
+    ElastircFactory.liveLogRanges; lines in those ranges are left to the live
+    writer. `lostOffsets` can then be a callable returning (and forgetting)
+    the offsets of lines the live writer dropped, like
+    ElastircFactory.takeLostLogOffsets; those are noted in the manifest as
+    missing, and each sync indexes just those lines. Otherwise, nothing else
+    should be indexing the same logs while syncing. Lines written but not
+    committed before a crash may be indexed twice, but none are skipped. If
+    the writer has `afterStop` hooks, like an IndexingPipeline, the live
+    ranges are also recorded once its final commit is done, so a clean
+    restart doesn't index them again.
+    """
+
+    def __init__(self, logDir, writer, manifest, liveRanges=None, lostOffsets=None):
+        self.logDir = logDir
+        self.writer = writer
+        self.manifest = manifest
+        self.liveRanges = liveRanges
+        self.lostOffsets = lostOffsets
+        if liveRanges is not None and hasattr(writer, 'afterStop'):
+            writer.afterStop.append(self.recordLiveRanges)
+
+    def _liveRanges(self):
+        if self.liveRanges is None:
+            return {}
+        return self.liveRanges()
+
+    def _liveSnapshot(self):
+        # The date is taken first, so that a log file opened for live writing
+        # after the ranges were taken is always dated on or after it.
+        today = datetime.date.today() if self.liveRanges is not None else None
+        return self._liveRanges(), today
+
+    def _noteLost(self):
+        if self.lostOffsets is None:
+            return
+        for name, offsets in self.lostOffsets().iteritems():
+            self.manifest.addMissing(name, offsets)
+
+    def indexTails(self, live, today=None, missing=None):
+        """Index the unindexed lines of each log file.
+
+        `live` maps log file names to the ranges written live. If `today` is
+        given, it's the date `live` was taken on, and log files dated then or
+        later which aren't in `live` are skipped: they could have been
+        opened for live writing since, so their tails may be indexed live
+        already. They're synced once they're in the live ranges, or once
+        their day is over. `missing` maps log file names to sorted lists of
+        the offsets of other lines to index, as from
+        ImportManifest.missingOffsets.
+
+        Returns the number of lines read, a dict mapping the names of the log
+        files whose tails were read to the offset they were read up to, and a
+        dict mapping log file names to the missing offsets which were
+        indexed.
+        """
+
+        nLines = 0
+        reached = {}
+        recovered = {}
+        if missing is None:
+            missing = {}
+        if not self.logDir.isdir():
+            # Nothing has been logged yet.
+            return nLines, reached, recovered
+        for channelDir in self.logDir.children():
+            if not channelDir.isdir():
+                continue
+            logPaths = channelDir.children()
+            names = set(logPath.basename() for logPath in logPaths)
+            for logPath in logPaths:
+                parsed = splitLogFileName(logPath.basename())
+                name = uncompressedLogName(logPath.basename())
+                if parsed is None or (name != logPath.basename() and name in names):
+                    # The uncompressed file is still there, so this one's
+                    # still being written by a LogCompactor.
+                    continue
+                channel, day = parsed
+                if name not in live and today is not None and day >= today:
+                    continue
+                start = tailStart = self.manifest.get(name)
+                lost = missing.get(name, [])
+                try:
+                    if name in live:
+                        end = live[name][0]
+                    else:
+                        end = logFileSize(logPath.path)
+                    if start >= end and not lost:
+                        continue
+                    infile = openLogFile(logPath.path)
+                except (IOError, OSError):
+                    # It was compressed since the directory was listed; it'll
+                    # be read from the compressed file next time.
+                    continue
+                found = []
+                with infile:
+                    for offset in lost:
+                        if tailStart <= offset < end:
+                            # The tail covers it.
+                            continue
+                        infile.seek(offset)
+                        line = infile.readline()
+                        if not line.endswith('\n'):
+                            # It hasn't been written out yet.
+                            continue
+                        doc = parseLogLine(line.decode('utf-8', 'replace'), channel, day)
+                        if doc is not None:
+                            doc['logOffset'] = offset
+                            self.writer.add_document(**doc)
+                        nLines += 1
+                        found.append(offset)
+                    if start < end:
+                        infile.seek(start)
+                        for line in infile:
+                            if start + len(line) > end or not line.endswith('\n'):
+                                break
+                            doc = parseLogLine(line.decode('utf-8', 'replace'), channel, day)
+                            if doc is not None:
+                                doc['logOffset'] = start
+                                self.writer.add_document(**doc)
+                            start += len(line)
+                            nLines += 1
+                        reached[name] = start
+                found.extend(offset for offset in lost if tailStart <= offset < start)
+                if found:
+                    recovered[name] = found
+        return nLines, reached, recovered
+
+    def _record(self, ignored, reached, live, recovered=None):
+        for name, offsets in (recovered or {}).iteritems():
+            self.manifest.removeMissing(name, offsets)
+        for name, (liveStart, liveEnd) in live.iteritems():
+            # Only once everything before the live range is indexed too.
+            if reached.get(name, self.manifest.get(name)) >= liveStart:
+                reached[name] = liveEnd
+        for name, offset in reached.iteritems():
+            self.manifest.set(name, offset)
+        self.manifest.save()
+
+    def recordLiveRanges(self):
+        """Record the live ranges as indexed, without syncing anything.
+
+        This is only right once everything given to the live writer has been
+        committed. Lines the live writer dropped are noted as missing.
+        """
+
+        self._noteLost()
+        self._record(None, {}, self._liveRanges())
+
+    def seedManifest(self):
+        """Record every log file as indexed up to its current end.
+
+        This is for an index built before there was a manifest, which has the
+        logs in it already; without this, the first sync indexes all of them
+        again. Returns the number of log files recorded.
+        """
+
+        seeded = 0
+        if not self.logDir.isdir():
+            return seeded
+        for channelDir in self.logDir.children():
+            if not channelDir.isdir():
+                continue
+            for logPath in channelDir.children():
+                if splitLogFileName(logPath.basename()) is None:
+                    continue
+                name = uncompressedLogName(logPath.basename())
+                try:
+                    size = logFileSize(logPath.path)
+                except (IOError, OSError):
+                    continue
+                self.manifest.set(name, max(size, self.manifest.get(name)))
+                seeded += 1
+        self.manifest.save()
+        return seeded
+
+    def sync(self):
+        """Index new lines, commit the writer, and update the manifest.
+
+        Returns the number of lines read.
+        """
+
+        self._noteLost()
+        live, today = self._liveSnapshot()
+        nLines, reached, recovered = self.indexTails(
+            live, today, self.manifest.missingOffsets())
+        self.writer.commit()
+        self._record(None, reached, live, recovered)
+        return nLines
+
+    def _commitSynced(self, result):
+        nLines, reached, recovered = result
+        # Every document given to the live writer so far is committed along
+        # with the synced ones, so the live ranges, which end before any
+        # document still held back, can be recorded as indexed as of right
+        # now; the ones it dropped are noted as missing instead.
+        live = self._liveRanges()
+        self._noteLost()
+        d = defer.maybeDeferred(self.writer.commit)
+        d.addCallback(self._record, reached, live, recovered)
+        d.addCallback(lambda ign: nLines)
+        return d
+
+    def syncInThread(self):
+        """Like sync, but read the log files in a thread.
+
+        This is suitable for a TimerService running alongside the live
+        writer, whose `commit` may return a Deferred. Returns a Deferred
+        which fires with the number of lines read. Errors are logged rather
+        than passed on, so that a TimerService keeps running it.
+        """
+
+        self._noteLost()
+        live, today = self._liveSnapshot()
+        d = threads.deferToThread(
+            self.indexTails, live, today, self.manifest.missingOffsets())
+        d.addCallback(self._commitSynced)
+        d.addErrback(log.err, 'error while syncing the logs')
+        return d
+
+
+class LogCompactor(object):
+    """Compress the plaintext logs of days which are over.
+
+    Each log file in `logDir` for a day before today is gzipped alongside
+    itself and then removed, so `#channel.2016-01-01` becomes
+    `#channel.2016-01-01.gz`. LogSyncer, the log importer and LogDirectory
+    all read the compressed files like the uncompressed ones. A day's log is
+    finished once a DatestampedLogFile flushes it after midnight, which is
+    within its `flushDelay`, so yesterday's logs are left alone until
+    `settleDelay` seconds after midnight.
+    """
+
+    compressLevel = 6
+    settleDelay = 60.0
+
+    def __init__(self, logDir):
+        self.logDir = logDir
+
+    def compress(self, logPath):
+        "Compress one log file, replacing it with its compressed version."
+        compressed = logPath.siblingExtension(compressedLogSuffix)
+        temporary = compressed.temporarySibling()
+        with logPath.open() as infile, temporary.open('w') as rawfile:
+            outfile = gzip.GzipFile(logPath.basename(), 'wb', self.compressLevel, rawfile)
+            shutil.copyfileobj(infile, outfile)
+            outfile.close()
+            os.fsync(rawfile.fileno())
+        temporary.moveTo(compressed)
+        logPath.remove()
+
+    def compact(self, today=None):
+        """Compress every log file for a day before `today`.
+
+        `today` defaults to the date it was `settleDelay` seconds ago. Returns
+        the number of files compressed, which is 0 if `logDir` doesn't exist
+        yet.
+        """
+
+        if today is None:
+            today = (datetime.datetime.now()
+                     - datetime.timedelta(seconds=self.settleDelay)).date()
+        compressed = 0
+        if not self.logDir.isdir():
+            return compressed
+        for channelDir in self.logDir.children():
+            if not channelDir.isdir():
+                continue
+            for logPath in channelDir.children():
+                name = logPath.basename()
+                parsed = splitLogFileName(name)
+                if parsed is None or uncompressedLogName(name) != name:
+                    continue
+                if parsed[1] < today:
+                    self.compress(logPath)
+                    compressed += 1
+        return compressed
+
+    def compactInThread(self):
+        """Like compact, but in a thread.
+
+        This is suitable for a TimerService. Returns a Deferred which fires
+        with the number of files compressed. Errors are logged rather than
+        passed on, so that a TimerService keeps running it.
+        """
+
+        d = threads.deferToThread(self.compact)
+        d.addErrback(log.err, 'error while compacting the logs')
+        return d
+
+
+class LogLineIndex(object):
+    """A sparse index of the lines of a log file, by number and by time.
+
+    The byte offset and time of every `every`th line are kept, so finding a
+    line reads at most `every` lines past the nearest one indexed. Building
+    the index reads the file once; after that, only lines appended since the
+    last update are read. Methods may be called from any thread.
+
+    Seeking in a gzip file means decompressing everything before the offset,
+    so a compressed log (which never changes) of up to `maxContents` bytes is
+    kept decompressed in `contents` instead. Larger compressed logs, or ones
+    whose `contents` have been dropped, are still read from the start of the
+    file for every window.
+    """
+
+    every = 256
+    maxContents = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.lines = 0
+        self.end = 0
+        self.contents = None
+        self._offsets = []
+        self._times = []
+
+    def _open(self):
+        contents = self.contents
+        if contents is not None:
+            return contextlib.closing(StringIO.StringIO(contents))
+        return openLogFile(self.path)
+
+    def dropContents(self):
+        "Stop keeping the decompressed contents of a compressed log."
+        self.contents = None
+
+    def _update(self):
+        size = logFileSize(self.path)
+        if size < self.end:
+            self._reset()
+        if (self.contents is None and self.path.endswith(compressedLogSuffix)
+                and size <= self.maxContents):
+            with openLogFile(self.path) as infile:
+                self.contents = infile.read()
+        if size == self.end:
+            return
+        with self._open() as infile:
+            infile.seek(self.end)
+            for line in infile:
+                if not line.endswith('\n'):
+                    break
+                if self.lines % self.every == 0:
+                    self._offsets.append(self.end)
+                    self._times.append(line[:8])
+                self.lines += 1
+                self.end += len(line)
+
+    def _linesFrom(self, infile, number):
+        "Yield (number, line) pairs from line `number` onward."
+        block = (number - 1) // self.every
+        current = block * self.every + 1
+        offset = self._offsets[block]
+        infile.seek(offset)
+        for line in infile:
+            offset += len(line)
+            if offset > self.end:
+                break
+            if current >= number:
+                yield current, line
+            current += 1
+
+    def _lineAt(self, infile, when):
+        block = max(bisect.bisect_left(self._times, when) - 1, 0)
+        for number, line in self._linesFrom(infile, block * self.every + 1):
+            if line[:8] >= when:
+                return number
+        return self.lines
+
+    def window(self, number=None, when=None, context=50):
+        """Return the lines around a line number or a time.
+
+        Lines are numbered from 1. If `when` is given, as 'HH:MM:SS', the
+        window is around the first line logged at or after then instead of
+        around line `number`. Returns the number of the line the window is
+        around, a list of (number, unicode line) pairs for up to `context`
+        lines either side of it, and the number of lines in the file.
+        """
+
+        with self._lock:
+            self._update()
+            if not self.lines:
+                return 1, [], 0
+            with self._open() as infile:
+                if when is not None:
+                    number = self._lineAt(infile, when)
+                number = min(max(number or 1, 1), self.lines)
+                first = max(number - context, 1)
+                lines = [
+                    (n, line.rstrip('\n').decode('utf-8', 'replace'))
+                    for n, line in itertools.islice(
+                        self._linesFrom(infile, first), number + context - first + 1)]
+            return number, lines, self.lines
+
+
+class LogLineIndexCache(object):
+    """The LogLineIndexes of the `maxEntries` most recently viewed log files.
+
+    The least recently viewed compressed logs drop their decompressed
+    contents to keep the total of them under `maxContentBytes`. This should
+    only be used from the reactor thread.
+    """
+
+    def __init__(self, maxEntries=256, maxContentBytes=64 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.maxContentBytes = maxContentBytes
+        self._entries = collections.OrderedDict()
+
+    def get(self, path):
+        "Return the LogLineIndex for the log file at `path`."
+        index = self._entries.pop(path, None)
+        if index is None:
+            index = LogLineIndex(path)
+        self._entries[path] = index
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+        total = 0
+        for cached in reversed(self._entries.values()):
+            contents = cached.contents
+            if contents is None:
+                continue
+            if total + len(contents) > self.maxContentBytes:
+                cached.dropContents()
+            else:
+                total += len(contents)
+        return index
+
 
 
 class DatestampedLogFile(BaseLogFile, object):
@@ -54,18 +986,39 @@ class DatestampedLogFile(BaseLogFile, object):
 
     The date format used as a suffix is controlled by the `datestampFormat`
     attribute.
+
+    Writes are buffered and written out together once `flushSize` bytes are
+    waiting or `flushDelay` seconds after the first of them, whichever comes
+    first, so at most `flushDelay` seconds of logs are lost if the process
+    dies. If `fsync` is true, the file is also fsynced after each flush, so
+    that nothing older than that is lost if the machine dies either.
+
+    If `writeLatency` is a Histogram, the time taken by each flush is
+    observed in it.
     """
 
     datestampFormat = DATE_FORMAT
-
-    def __init__(self, name, directory, defaultMode=None):
+    flushSize = 64 * 1024
+    flushDelay = 1.0
+    fsync = False
+    writeLatency = None
+
+    def __init__(self, name, directory, defaultMode=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
         self.basePath = os.path.join(directory, name)
+        self.day = datetime.date.today()
+        self.liveRanges = {}
+        self._pending = []
+        self._pendingSize = 0
+        self._delayedFlush = None
         BaseLogFile.__init__(self, name, directory, defaultMode)
         self.lastPath = self.path
 
     def _getPath(self):
         "The logfile path will always be the base path with a dated suffix."
-        return '%s.%s' % (self.basePath, self.suffix())
+        return '%s.%s' % (self.basePath, self.suffix(self.day))
 
     def _setPath(self, ignored):
         "Assignment to the `path` attribute is ignored."
@@ -73,11 +1026,75 @@ class DatestampedLogFile(BaseLogFile, object):
 
     path = property(_getPath, _setPath)
 
+    def _openFile(self):
+        """Open the log file, noting where this process started writing to it.
+
+        The `liveRanges` attribute maps the name of each file this LogFile has
+        written to the range of bytes it wrote there, including any bytes
+        still waiting to be flushed.
+        """
+
+        BaseLogFile._openFile(self)
+        self._name = os.path.basename(self._file.name)
+        self._end = self._file.tell()
+        self.liveRanges.setdefault(self._name, [self._end, self._end])
+
+    def write(self, data, when=None):
+        """Queue some data to be written to the log for the date of `when`.
+
+        `when` defaults to now. Returns the offset in that day's log file at
+        which the data will be written.
+        """
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if when is None:
+            when = datetime.datetime.now()
+        day = when.date()
+        if day != self.day:
+            self.flush()
+            self.day = day
+            if self.shouldRotate():
+                self.rotate()
+        offset = self._end
+        self._pending.append(data)
+        self._pendingSize += len(data)
+        self._end += len(data)
+        self.liveRanges[self._name][1] = self._end
+        if self._pendingSize >= self.flushSize:
+            self.flush()
+        elif self._delayedFlush is None:
+            self._delayedFlush = self.clock.callLater(self.flushDelay, self.flush)
+        return offset
+
+    def flush(self):
+        "Write out everything waiting to be written."
+        if self._delayedFlush is not None:
+            if self._delayedFlush.active():
+                self._delayedFlush.cancel()
+            self._delayedFlush = None
+        if not self._pending:
+            return
+        started = time.time()
+        data = ''.join(self._pending)
+        self._pending = []
+        self._pendingSize = 0
+        self._file.write(data)
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        if self.writeLatency is not None:
+            self.writeLatency.observe(time.time() - started)
+
+    def close(self):
+        "Flush and close the file."
+        self.flush()
+        BaseLogFile.close(self)
+
     def shouldRotate(self):
         """Returns True if the log should be rotated.
 
-        Logs are only rotated when the current date is different from the date
-        of the last log message.
+        Logs are only rotated when the date of a message is different from the
+        date of the last log message.
         """
 
         return self.path != self.lastPath
@@ -89,6 +1106,7 @@ class DatestampedLogFile(BaseLogFile, object):
         # name they'll always have), just close the old log file and open the
         # new one.
         self.reopen()
+        self.lastPath = self.path
 
     def suffix(self, when=None):
         """Determine the suffix for log files, optionally for a given datetime.
@@ -101,6 +1119,1115 @@ class DatestampedLogFile(BaseLogFile, object):
         return when.strftime(self.datestampFormat)
 
 
+class SearcherManager(object):
+    """Keeps open searchers for the searches of an index.
+
+    Opening a searcher opens a reader for every segment and throws away
+    Whoosh's caches, so searchers are kept open and reused rather than opened
+    for every search. Whoosh searchers aren't safe to use from more than one
+    thread at once, though, so each searcher is only handed to one search at
+    a time: a search takes an idle searcher, or opens one if there are none,
+    and gives it back to the pool of idle searchers once it's done. At most
+    `maxIdle` idle searchers are kept open. `generation` is a callable
+    returning the current generation, which defaults to asking the index.
+
+    An idle searcher from an older generation is refreshed when it's next
+    taken, reusing the readers of segments which haven't changed.
+    """
+
+    maxIdle = 8
+
+    def __init__(self, index, generation=None):
+        self.index = index
+        if generation is None:
+            generation = index.latest_generation
+        self.generation = generation
+        self._lock = threading.Lock()
+        self._idle = []
+        self._inUse = {}
+        self._epoch = 0
+
+    def acquire(self):
+        "Return an up-to-date searcher, which must be passed to `release` later."
+        generation = self.generation()
+        with self._lock:
+            if self._idle:
+                searcher, searcherGeneration = self._idle.pop()
+            else:
+                searcher = searcherGeneration = None
+            epoch = self._epoch
+        if searcher is None:
+            searcher = self.index.searcher()
+        elif searcherGeneration != generation:
+            # Nothing else can be using it, so it's safe to let refresh close
+            # whichever of its readers won't be reused.
+            searcher = searcher.refresh()
+        with self._lock:
+            self._inUse[searcher] = epoch, generation
+        return searcher
+
+    def release(self, searcher):
+        with self._lock:
+            epoch, generation = self._inUse.pop(searcher)
+            if epoch == self._epoch and len(self._idle) < self.maxIdle:
+                self._idle.append((searcher, generation))
+                return
+        searcher.close()
+
+    @contextlib.contextmanager
+    def searcher(self):
+        "A context manager for acquiring and releasing a searcher."
+        searcher = self.acquire()
+        try:
+            yield searcher
+        finally:
+            self.release(searcher)
+
+    def close(self):
+        """Close the idle searchers, and the others once their searches are done.
+
+        Searches after this open new searchers as usual.
+        """
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._epoch += 1
+        for searcher, generation in idle:
+            searcher.close()
+
+
+@contextlib.contextmanager
+def _singleSearcher(searcherContext):
+    with searcherContext as searcher:
+        yield [searcher]
+
+
+class IndexingPipeline(object):
+    """Adds documents to a Whoosh index from a thread of its own.
+
+    This stands in for a Whoosh writer: `add_document` only puts the document
+    on a queue, and the pipeline's thread adds queued documents to the index,
+    committing after `commitCount` documents or `commitDelay` seconds. Each
+    commit merges small segments, and once a day, during the hour
+    `optimizeHour`, the index is fully optimized (and, for a TimeShardedIndex,
+    past months are frozen); either way that all happens in the pipeline's
+    thread rather than the reactor's. The `generation` attribute is the
+    index's generation as of the last commit, and the time each commit takes
+    is observed in the `commitDurations` Histogram.
+
+    The index can be a Whoosh index or a ShardedIndex. When the pipeline is
+    stopped, callables in `beforeStop` are called first, and the thread waits
+    for any Deferreds they return before making its final commit; documents
+    added after that are dropped. Callables in `afterStop` are called once
+    the thread has made its final commit and stopped.
+
+    At most `maxQueued` documents wait in the queue. When it's full, documents
+    added from the reactor thread are dropped (and counted in `dropped`),
+    since the reactor can't wait; documents added from any other thread wait
+    for room (counted in `waits`). The plaintext logs still have any dropped
+    documents. Commits don't count towards `maxQueued`, so `commit` never
+    waits.
+
+    A document which can't be added, or a commit which fails, is logged and
+    counted in `errors`, and the thread carries on; the Deferred returned by
+    `commit` fails if the commit it waited for did. Documents for a frozen
+    shard of a ShardedIndex are skipped and counted in `frozenSkipped`.
+    """
+
+    commitCount = 1000
+    commitDelay = 10.0
+    maxQueued = 10000
+    optimizeHour = 4
+
+    _stop = object()
+
+    def __init__(self, index, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.index = index
+        self.queued = self.dropped = self.waits = 0
+        self.indexed = self.commits = self.optimizes = 0
+        self.errors = self.frozenSkipped = 0
+        self.lastCommitDuration = None
+        self.commitDurations = Histogram()
+        self.generation = index.latest_generation()
+        self.searchers = SearcherManager(index, lambda: self.generation)
+        self._queue = Queue.Queue()
+        self._room = threading.Condition()
+        self._documentsQueued = 0
+        self.beforeStop = []
+        self.afterStop = []
+        self._thread = None
+        self._stopping = None
+        self._stopped = None
+        self._shutdownTrigger = None
+        self._lastOptimized = datetime.date.today()
+
+    @property
+    def queueDepth(self):
+        "The number of documents and commits waiting for the pipeline's thread."
+        return self._queue.qsize()
+
+    def start(self):
+        "Start the thread and arrange for it to be stopped at shutdown."
+        if self._thread is not None:
+            return
+        self._stopping = None
+        self._stopped = defer.Deferred()
+        self._thread = threading.Thread(target=self._run, name='elastirc-indexing')
+        self._thread.daemon = True
+        self._thread.start()
+        self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+            'before', 'shutdown', self._stopAtShutdown)
+
+    def stop(self):
+        """Commit everything queued and stop the thread.
+
+        Returns a Deferred which fires once the thread is done.
+        """
+
+        if self._shutdownTrigger is not None:
+            self.reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        return self._stopAtShutdown()
+
+    def _stopAtShutdown(self):
+        self._shutdownTrigger = None
+        if self._thread is None or self._stopping is not None:
+            return defer.succeed(None)
+        d = self._stopping = self._runHooks(self.beforeStop, 'before stopping')
+        d.addCallback(self._stopThread)
+        d.addCallback(lambda ign: self._runHooks(self.afterStop, 'after stopping'))
+        return d
+
+    def _stopThread(self, ignored):
+        self._thread = None
+        self._queue.put(self._stop)
+        return self._stopped
+
+    def _runHooks(self, hooks, when):
+        ds = []
+        for hook in hooks:
+            d = defer.maybeDeferred(hook)
+            d.addErrback(log.err, 'error %s the indexing pipeline' % (when,))
+            ds.append(d)
+        return defer.gatherResults(ds)
+
+    def add_document(self, **fields):
+        """Queue a document to be added to the index.
+
+        Returns False if the document was dropped because the queue was full
+        or the pipeline is stopping.
+        """
+
+        if self._thread is None and self._stopping is not None:
+            self.dropped += 1
+            return False
+        self.start()
+        with self._room:
+            if self._documentsQueued >= self.maxQueued:
+                if threadable.isInIOThread():
+                    self.dropped += 1
+                    return False
+                self.waits += 1
+                while self._documentsQueued >= self.maxQueued:
+                    self._room.wait()
+            self._documentsQueued += 1
+        self._queue.put(fields)
+        self.queued += 1
+        return True
+
+    def commit(self):
+        """Commit everything queued so far.
+
+        Returns a Deferred which fires once the commit is done, or fails if
+        the commit failed. Unlike documents, commits are never dropped. Once
+        the pipeline has stopped, everything was committed already, so this
+        returns a Deferred which has already fired.
+        """
+
+        if self._thread is None and self._stopping is not None:
+            return defer.succeed(None)
+        self.start()
+        d = defer.Deferred()
+        self._queue.put(d)
+        return d
+
+    def searcher(self):
+        """Return a context manager for a searcher as of the last commit.
+
+        The searcher comes from the `searchers` SearcherManager, and isn't used
+        by any other search until this one is done with it.
+        """
+
+        return self.searchers.searcher()
+
+    def searchersFor(self, start=None, end=None, channels=None):
+        """Return a context manager for a list of searchers for a search.
+
+        If the index is a ShardedIndex, this has a searcher for each shard
+        the search needs to look at; see ShardedIndex.searchers.
+        """
+
+        if isinstance(self.index, ShardedIndex):
+            return self.index.searchers(start, end, channels)
+        return _singleSearcher(self.searcher())
+
+    def _run(self):
+        writer = None
+        uncommitted = 0
+        waiting = []
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Queue.Empty:
+                item = None
+            if isinstance(item, dict):
+                with self._room:
+                    self._documentsQueued -= 1
+                    self._room.notify()
+                try:
+                    if writer is None:
+                        writer = self.index.writer()
+                        deadline = time.time() + self.commitDelay
+                    writer.add_document(**item)
+                except FrozenShardError as e:
+                    log.msg('not indexing a document for frozen shard %s' % (e,))
+                    self.frozenSkipped += 1
+                    continue
+                except Exception:
+                    log.err(None, 'error adding a document to the index')
+                    self.errors += 1
+                    continue
+                uncommitted += 1
+                if uncommitted < self.commitCount:
+                    continue
+            elif isinstance(item, defer.Deferred):
+                waiting.append(item)
+            failed = None
+            try:
+                if writer is not None:
+                    self._commit(writer, uncommitted)
+            except Exception:
+                failed = Failure()
+                log.err(failed, 'error committing to the index')
+                self.errors += 1
+                try:
+                    writer.cancel()
+                except Exception:
+                    log.err(None, 'error cancelling the index writer')
+            writer, uncommitted, deadline = None, 0, None
+            for d in waiting:
+                if failed is None:
+                    self.reactor.callFromThread(d.callback, None)
+                else:
+                    self.reactor.callFromThread(d.errback, failed)
+            waiting = []
+            if item is self._stop:
+                try:
+                    self.searchers.close()
+                    if isinstance(self.index, ShardedIndex):
+                        self.index.close()
+                except Exception:
+                    log.err(None, 'error closing the index')
+                self.reactor.callFromThread(self._stopped.callback, None)
+                return
+
+    def _commit(self, writer, uncommitted):
+        started = time.time()
+        today = datetime.date.today()
+        if (self.optimizeHour is not None and self._lastOptimized != today
+                and datetime.datetime.now().hour == self.optimizeHour):
+            writer.commit(optimize=True)
+            if isinstance(self.index, TimeShardedIndex):
+                self.index.freezeOldShards()
+            self._lastOptimized = today
+            self.optimizes += 1
+        else:
+            writer.commit()
+        self.generation = self.index.latest_generation()
+        self.indexed += uncommitted
+        self.commits += 1
+        self.lastCommitDuration = time.time() - started
+        self.commitDurations.observe(self.lastCommitDuration)
+
+    def metrics(self):
+        "Return metrics about the pipeline; see formatMetrics."
+        return [
+            ('elastirc_index_queued_total', 'counter',
+             'Documents queued to be indexed.', self.queued),
+            ('elastirc_index_dropped_total', 'counter',
+             'Documents dropped because the queue was full or the pipeline was stopping.',
+             self.dropped),
+            ('elastirc_index_waits_total', 'counter',
+             'Times a thread waited for room in the queue.', self.waits),
+            ('elastirc_index_indexed_total', 'counter',
+             'Documents committed to the index.', self.indexed),
+            ('elastirc_index_commits_total', 'counter',
+             'Commits to the index.', self.commits),
+            ('elastirc_index_optimizes_total', 'counter',
+             'Full optimizations of the index.', self.optimizes),
+            ('elastirc_index_errors_total', 'counter',
+             'Documents or commits which failed with an error.', self.errors),
+            ('elastirc_index_frozen_skipped_total', 'counter',
+             'Documents not indexed because their shard was frozen.', self.frozenSkipped),
+            ('elastirc_index_queue_depth', 'gauge',
+             'Documents and commits waiting for the indexing thread.', self.queueDepth),
+            ('elastirc_index_commit_duration_seconds', 'histogram',
+             'Time taken by each commit.', self.commitDurations),
+        ]
+
+
+class IngestGate(object):
+    """Decides which logged documents go on to be indexed, and when.
+
+    This sits between ElastircFactory.logDocument and the writer, and only
+    ever holds back documents from the index; the plaintext logs always get
+    every line. Conversation (documents with any of `highPriorityFields`,
+    such as messages and actions) is high priority, and membership and mode
+    changes are low priority.
+
+    Each channel's documents are metered by a token bucket refilling at
+    `channelRate` documents a second, up to `channelBurst`. The writer is
+    past its high-water mark once its `queueDepth`, if it has one, reaches
+    `highWater`. Low-priority documents are held back when their channel is
+    over its rate or the writer is past its high-water mark; high-priority
+    ones only when both are true, as in a spam flood. Held back documents
+    are dropped if `policy` is 'shed'. If it's 'defer', they're kept, up to
+    `maxDeferred` of them, and passed on `drainBatch` at a time every
+    `drainDelay` seconds while the writer's queue is below `lowWater`. If the
+    writer has `beforeStop` hooks, like an IndexingPipeline, every deferred
+    document is passed on before its final commit; see `flush`.
+
+    Shed documents are never indexed, not even by a LogSyncer: like every
+    other line of the live logs, their lines are recorded as indexed. Deferred
+    documents hold back the recording of their log file's live range until
+    they're passed on; see `pendingOffsets`. Documents the writer drops (an
+    IndexingPipeline with a full queue, say) are noted by log file and offset
+    so that a LogSyncer can index just those lines; see `takeLostOffsets`.
+
+    This must only be used from the reactor thread.
+    """
+
+    highPriorityFields = frozenset(['message', 'topic', 'kicker'])
+    channelRate = 50.0
+    channelBurst = 500.0
+    highWater = 5000
+    lowWater = 1000
+    policy = 'defer'
+    maxDeferred = 50000
+    drainBatch = 1000
+    drainDelay = 1.0
+
+    def __init__(self, writer, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.writer = writer
+        self.admitted = collections.Counter()
+        self.deferrals = collections.Counter()
+        self.shed = collections.Counter()
+        self._buckets = {}
+        self._deferred = collections.deque()
+        self._delayedDrain = None
+        self._lost = {}
+        if hasattr(writer, 'beforeStop'):
+            writer.beforeStop.append(self.flush)
+
+    def priorityOf(self, document):
+        "Return 'high' or 'low', the priority class of a document."
+        if self.highPriorityFields.intersection(document):
+            return 'high'
+        return 'low'
+
+    def _queueDepth(self):
+        return getattr(self.writer, 'queueDepth', 0)
+
+    def _overRate(self, channel):
+        now = self.clock.seconds()
+        tokens, updated = self._buckets.get(channel, (self.channelBurst, now))
+        tokens = min(tokens + (now - updated) * self.channelRate, self.channelBurst)
+        overRate = tokens < 1
+        if not overRate:
+            tokens -= 1
+        self._buckets[channel] = tokens, now
+        return overRate
+
+    def add_document(self, **fields):
+        """Pass a document on to the writer, or hold it back.
+
+        Returns True if the document was passed on.
+        """
+
+        priority = self.priorityOf(fields)
+        overRate = self._overRate(fields.get('channel'))
+        pastHighWater = self._queueDepth() >= self.highWater
+        if priority == 'high':
+            admit = not (overRate and pastHighWater)
+        else:
+            admit = not (overRate or pastHighWater)
+        if admit:
+            self.admitted[priority] += 1
+            self._passOn(fields)
+            return True
+        key = priority, fields.get('channel')
+        if self.policy == 'defer' and len(self._deferred) < self.maxDeferred:
+            self.deferrals[key] += 1
+            self._deferred.append(fields)
+            if self._delayedDrain is None:
+                self._delayedDrain = self.clock.callLater(self.drainDelay, self._drain)
+        else:
+            self.shed[key] += 1
+        return False
+
+    def _passOn(self, fields):
+        if self.writer.add_document(**fields) is not False:
+            return
+        position = self._logPosition(fields)
+        if position is not None:
+            name, offset = position
+            self._lost.setdefault(name, []).append(offset)
+
+    def _logPosition(self, fields):
+        offset, when = fields.get('logOffset'), fields.get('receivedAt')
+        if offset is None or when is None:
+            return None
+        return logFileName(fields['channel'], when.date()), offset
+
+    def pendingOffsets(self):
+        """Return where the documents still deferred start.
+
+        This is a dict mapping the name of each log file with any documents
+        still deferred to the offset of the earliest of them.
+        """
+
+        ret = {}
+        for fields in self._deferred:
+            position = self._logPosition(fields)
+            if position is None:
+                continue
+            name, offset = position
+            if offset < ret.get(name, offset + 1):
+                ret[name] = offset
+        return ret
+
+    def takeLostOffsets(self):
+        """Return and forget the offsets of the documents the writer dropped.
+
+        This is a dict mapping log file names to lists of offsets.
+        """
+
+        lost, self._lost = self._lost, {}
+        return lost
+
+    def _drain(self):
+        self._delayedDrain = None
+        for _ in xrange(self.drainBatch):
+            if not self._deferred or self._queueDepth() >= self.lowWater:
+                break
+            self._passOn(self._deferred.popleft())
+        if self._deferred:
+            self._delayedDrain = self.clock.callLater(self.drainDelay, self._drain)
+
+    def flush(self):
+        """Pass every deferred document on to the writer.
+
+        Documents are passed on as fast as the writer's queue stays below
+        `highWater`, regardless of rates. Returns a Deferred which fires once
+        none are left.
+        """
+
+        if self._delayedDrain is not None:
+            self._delayedDrain.cancel()
+            self._delayedDrain = None
+        d = defer.Deferred()
+        self._flushSome(d)
+        return d
+
+    def _flushSome(self, d):
+        while self._deferred and self._queueDepth() < self.highWater:
+            self._passOn(self._deferred.popleft())
+        if self._deferred:
+            self.clock.callLater(self.drainDelay, self._flushSome, d)
+        else:
+            d.callback(None)
+
+    def metrics(self):
+        "Return metrics about what was admitted, deferred and shed; see formatMetrics."
+        def byPriorityAndChannel(counter):
+            return dict(((('priority', priority), ('channel', channel)), count)
+                        for (priority, channel), count in counter.iteritems())
+        return [
+            ('elastirc_ingest_admitted_total', 'counter',
+             'Documents passed straight on to be indexed, by priority.',
+             dict(((('priority', priority),), count)
+                  for priority, count in self.admitted.iteritems())),
+            ('elastirc_ingest_deferred_total', 'counter',
+             'Documents held back to be indexed later, by priority and channel.',
+             byPriorityAndChannel(self.deferrals)),
+            ('elastirc_ingest_shed_total', 'counter',
+             'Documents never indexed because of load, by priority and channel.',
+             byPriorityAndChannel(self.shed)),
+            ('elastirc_ingest_deferred', 'gauge',
+             'Documents waiting to be indexed later.', len(self._deferred)),
+        ]
+
+
+class SearchQueueFull(Exception):
+    "Raised when a search is rejected because too many are already pending."
+
+
+class SearchPool(object):
+    """A bounded pool of threads for running index searches.
+
+    At most `concurrency` searches will run at once, and at most `queueDepth`
+    more will wait for a free thread; any searches beyond that fail
+    immediately with SearchQueueFull. This keeps a burst of searches from
+    starving the reactor thread, which is also busy logging IRC.
+
+    A search of several shards can search them in parallel with `map`, using
+    a separate pool of `fanOut` threads shared by all searches.
+    """
+
+    def __init__(self, concurrency=4, queueDepth=16, fanOut=4, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.concurrency = concurrency
+        self.queueDepth = queueDepth
+        self.threadpool = ThreadPool(0, concurrency, 'elastirc-search')
+        self.fanOutThreadpool = ThreadPool(0, fanOut, 'elastirc-search-fan-out')
+        self.pending = self.rejected = 0
+        self._shutdownTrigger = None
+
+    def start(self):
+        "Start the threads and arrange for them to be stopped at shutdown."
+        if self.threadpool.started:
+            return
+        self.threadpool.start()
+        self.fanOutThreadpool.start()
+        self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._stopAtShutdown)
+
+    def stop(self):
+        "Stop the threads, waiting for any running searches to finish."
+        if self._shutdownTrigger is not None:
+            self.reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        self._stopAtShutdown()
+
+    def _stopAtShutdown(self):
+        self._shutdownTrigger = None
+        self.threadpool.stop()
+        self.fanOutThreadpool.stop()
+
+    def map(self, f, items):
+        """Call `f` on each item in parallel and return the results in order.
+
+        This waits for the results, so it's meant to be called from a search
+        thread, never the reactor thread. If any call raises an exception, the
+        first one is reraised.
+        """
+
+        items = list(items)
+        if len(items) < 2:
+            return [f(item) for item in items]
+        results = Queue.Queue()
+        for n, item in enumerate(items):
+            self.fanOutThreadpool.callInThreadWithCallback(
+                lambda succeeded, result, n=n: results.put((n, succeeded, result)), f, item)
+        ret = [None] * len(items)
+        failures = []
+        for _ in items:
+            n, succeeded, result = results.get()
+            if succeeded:
+                ret[n] = result
+            else:
+                failures.append((n, result))
+        if failures:
+            min(failures)[1].raiseException()
+        return ret
+
+    def run(self, f, *args, **kwargs):
+        """Call `f` in a search thread.
+
+        Returns a Deferred which fires with the result of `f`, or fails with
+        SearchQueueFull if there was no room to queue the call.
+        """
+
+        if self.pending >= self.concurrency + self.queueDepth:
+            self.rejected += 1
+            return defer.fail(SearchQueueFull(self.pending))
+        self.start()
+        self.pending += 1
+        d = threads.deferToThreadPool(self.reactor, self.threadpool, f, *args, **kwargs)
+        d.addBoth(self._finished)
+        return d
+
+    def _finished(self, result):
+        self.pending -= 1
+        return result
+
+    def metrics(self):
+        "Return metrics about the pool; see formatMetrics."
+        return [
+            ('elastirc_search_pending', 'gauge',
+             'Searches running or waiting for a thread.', self.pending),
+            ('elastirc_search_rejected_total', 'counter',
+             'Searches rejected because too many were pending.', self.rejected),
+        ]
+
+
+class SearchPage(object):
+    """Which page of search results to fetch.
+
+    Pages are `size` hits long and sorted by `receivedAt`. A page reached from
+    the previous one carries a cursor: the `receivedAt` of the last hit shown
+    (`after`) and how many hits at exactly that time were already shown
+    (`skip`). Fetching a page with a cursor only collects about `size` hits no
+    matter how deep the page is. Without a cursor, every hit before page
+    `number` has to be collected to find it.
+    """
+
+    def __init__(self, number=1, size=50, after=None, skip=0):
+        self.number = number
+        self.size = size
+        self.after = after
+        self.skip = skip
+
+    @classmethod
+    def fromArgs(cls, args, defaultSize, maxSize):
+        "Build a SearchPage from the `page`, `size`, and `after` request args."
+        number = max(intArg(args, 'page', 1), 1)
+        size = min(max(intArg(args, 'size', defaultSize), 1), maxSize)
+        after, skip = None, 0
+        cursor = args.get('after', [''])[0]
+        if cursor:
+            when, _, skip = cursor.partition(',')
+            try:
+                after = datetime.datetime.strptime(when, CURSOR_FORMAT)
+                skip = max(int(skip), 0)
+            except ValueError:
+                after, skip = None, 0
+        return cls(number, size, after, skip)
+
+    @property
+    def offset(self):
+        "How many of the collected hits come before this page."
+        if self.after is None:
+            return (self.number - 1) * self.size
+        return self.skip
+
+    def filter(self, q):
+        "Restrict a query to hits at or after this page's cursor."
+        if self.after is None:
+            return q
+        return query.And([q, query.DateRange('receivedAt', self.after, None)])
+
+    def cursor(self):
+        "The cursor, formatted for use as the `after` request arg."
+        return '%s,%d' % (self.after.strftime(CURSOR_FORMAT), self.skip)
+
+    def search(self, searchers, q, map=map):
+        """Fetch this page of hits for a query from some searchers.
+
+        Each searcher is searched for the hits up to the end of this page, and
+        those are merged in `receivedAt` order. The searchers are searched
+        using `map`, which can be replaced to search them in parallel. Returns
+        a SearchResults, whose `nextPage` is set if there are more hits after
+        this page.
+        """
+
+        started = time.time()
+        offset = self.offset
+        limit = offset + self.size + 1
+        q = self.filter(q)
+
+        def collect((n, searcher)):
+            results = searcher.search(q, limit=limit, sortedby='receivedAt')
+            return [(hit['receivedAt'], n, i, hit) for i, hit in enumerate(results)]
+
+        hitLists = map(collect, enumerate(searchers))
+        merged = list(itertools.islice(heapq.merge(*hitLists), limit))
+        hits = [hit.fields() for _, _, _, hit in merged[offset:offset + self.size]]
+        nextPage = None
+        if len(merged) > offset + self.size:
+            last = hits[-1]['receivedAt']
+            ties = 1
+            for i in xrange(offset + self.size - 2, -1, -1):
+                if merged[i][0] != last:
+                    break
+                ties += 1
+            nextPage = SearchPage(self.number + 1, self.size, last, ties)
+        return SearchResults(hits, time.time() - started, self, nextPage)
+
+
+class FrozenShardError(Exception):
+    "Raised when trying to write to a shard which has been frozen."
+
+
+class ShardedWriter(object):
+    """Acts as a single Whoosh writer for all of the shards of a ShardedIndex.
+
+    A writer is opened for each shard as documents for it are added, with
+    the keyword arguments passed in as `writerArgs`.
+    """
+
+    def __init__(self, index, writerArgs):
+        self.index = index
+        self.writerArgs = writerArgs
+        self.writers = {}
+
+    def add_document(self, **fields):
+        name = self.index.shardFor(fields)
+        writer = self.writers.get(name)
+        if writer is None:
+            if self.index.isFrozen(name):
+                raise FrozenShardError(name)
+            writer = self.writers[name] = self.index.shard(name).writer(**self.writerArgs)
+        writer.add_document(**fields)
+
+    def commit(self, **kwargs):
+        writers, self.writers = self.writers, {}
+        for writer in writers.itervalues():
+            writer.commit(**kwargs)
+
+    def cancel(self):
+        writers, self.writers = self.writers, {}
+        for writer in writers.itervalues():
+            writer.cancel()
+
+
+class ShardedIndex(object):
+    """A set of Whoosh indexes in subdirectories of `path`, one per shard.
+
+    Subclasses decide which shard each document belongs in by implementing
+    `shardFor`, and which shards a search has to look at by implementing
+    `shardsFor`. Otherwise, this can be used in place of a Whoosh index by an
+    IndexingPipeline, log-importer.py, or a LogSyncer.
+
+    A shard which won't be written to any more can be frozen: it's fully
+    optimized, and from then on writing to it raises FrozenShardError.
+    """
+
+    frozenMarker = 'FROZEN'
+
+    def __init__(self, path, schema=whooshSchema):
+        self.path = path
+        self.schema = schema
+        if not path.exists():
+            path.makedirs()
+        self._lock = threading.Lock()
+        self._shards = {}
+        self._searchers = {}
+        self._generations = {}
+
+    def shardFor(self, document):
+        "Return the name of the shard a document belongs in."
+        raise NotImplementedError()
+
+    def shardsFor(self, start=None, end=None, channels=None):
+        """Return the names of the shards which a search has to look at.
+
+        `start` and `end` are the datetimes bounding the `receivedAt` of the
+        documents searched for, and `channels` the unprefixed names of the
+        channels searched, if known.
+        """
+
+        raise NotImplementedError()
+
+    def is_empty(self):
+        "Return True if no shard has any documents, like a Whoosh index."
+        return all(self.shard(name).is_empty() for name in self.shardNames())
+
+    def shardNames(self):
+        "Return the names of all of the shards, in order."
+        return sorted(child.basename() for child in self.path.children() if child.isdir())
+
+    def shard(self, name):
+        "Return the Whoosh index for a shard, creating the shard if necessary."
+        with self._lock:
+            ret = self._shards.get(name)
+            if ret is not None:
+                return ret
+            shardPath = self.path.child(name)
+            if whooshIndex.exists_in(shardPath.path):
+                ret = whooshIndex.open_dir(shardPath.path)
+                if not self.isFrozen(name):
+                    upgradeIndexSchema(ret, self.schema)
+            else:
+                if not shardPath.exists():
+                    shardPath.makedirs()
+                ret = whooshIndex.create_in(shardPath.path, self.schema)
+            self._shards[name] = ret
+            return ret
+
+    def isFrozen(self, name):
+        return self.path.child(name).child(self.frozenMarker).exists()
+
+    def freeze(self, name):
+        "Optimize a shard and mark it read-only."
+        self.shard(name).writer().commit(optimize=True)
+        self.path.child(name).child(self.frozenMarker).touch()
+
+    def writer(self, **kwargs):
+        return ShardedWriter(self, kwargs)
+
+    def latest_generation(self):
+        """Return the generations of every shard.
+
+        This also notes them for the shards' SearcherManagers, so that they
+        refresh their searchers.
+        """
+
+        generations = []
+        for name in self.shardNames():
+            generation = self._generations.get(name)
+            if generation is None or not self.isFrozen(name):
+                generation = self.shard(name).latest_generation()
+                self._generations[name] = generation
+            generations.append((name, generation))
+        return tuple(generations)
+
+    def _searcherManager(self, name):
+        with self._lock:
+            manager = self._searchers.get(name)
+            if manager is None:
+                manager = self._searchers[name] = SearcherManager(
+                    None, lambda: self._generations.get(name))
+        if manager.index is None:
+            manager.index = self.shard(name)
+        return manager
+
+    @contextlib.contextmanager
+    def searchers(self, start=None, end=None, channels=None):
+        """A context manager for searchers of each shard a search needs.
+
+        The arguments are the same as `shardsFor`'s.
+        """
+
+        acquired = []
+        try:
+            for name in self.shardsFor(start, end, channels):
+                manager = self._searcherManager(name)
+                acquired.append((manager, manager.acquire()))
+            yield [searcher for manager, searcher in acquired]
+        finally:
+            for manager, searcher in acquired:
+                manager.release(searcher)
+
+    def close(self):
+        "Stop holding searchers open once current searches are done."
+        with self._lock:
+            managers = self._searchers.values()
+        for manager in managers:
+            manager.close()
+
+
+class TimeShardedIndex(ShardedIndex):
+    """A ShardedIndex with a shard for each month of `receivedAt`.
+
+    Searches limited to a range of dates only look at the months which
+    overlap it. `freezeOldShards` freezes the shards of past months.
+    """
+
+    shardFormat = '%Y-%m'
+
+    def shardFor(self, document):
+        return document['receivedAt'].strftime(self.shardFormat)
+
+    def shardBounds(self, name):
+        "Return the start of a shard's month and the start of the next."
+        start = datetime.datetime.strptime(name, self.shardFormat)
+        return start, (start + datetime.timedelta(days=32)).replace(day=1)
+
+    def shardsFor(self, start=None, end=None, channels=None):
+        ret = []
+        for name in self.shardNames():
+            shardStart, shardEnd = self.shardBounds(name)
+            if start is not None and shardEnd <= start:
+                continue
+            if end is not None and shardStart >= end:
+                continue
+            ret.append(name)
+        return ret
+
+    def freezeOldShards(self):
+        "Freeze every shard from before this month."
+        thisMonth = datetime.datetime.now().strftime(self.shardFormat)
+        for name in self.shardNames():
+            if name < thisMonth and not self.isFrozen(name):
+                self.freeze(name)
+
+
+class ChannelShardedIndex(ShardedIndex):
+    """A ShardedIndex with a shard for each channel.
+
+    Searches only look at the shards of the channels searched, so searching a
+    small channel never reads the postings of a big one. Shards are named
+    after the unprefixed channel, quoted to be safe as a directory name.
+    """
+
+    def shardFor(self, document):
+        return self.shardName(document['channel'].encode('utf-8'))
+
+    def shardName(self, channel):
+        return urllib.quote(channel, safe='#&+!')
+
+    def shardsFor(self, start=None, end=None, channels=None):
+        names = self.shardNames()
+        if channels is not None:
+            wanted = set(self.shardName(channel) for channel in channels)
+            names = [name for name in names if name in wanted]
+        return names
+
+
+class SearchResultCache(object):
+    """A cache of pages of search results.
+
+    Results are cached along with the generation of the index they came from,
+    and the whole cache is emptied as soon as a newer generation is seen, so
+    nothing from before a commit is ever served after it. The least recently
+    used results are evicted to keep the (roughly estimated) size of the
+    cached hits under `maxBytes`.
+    """
+
+    def __init__(self, maxBytes=16 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.generation = None
+        self.hits = self.misses = self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def _checkGeneration(self, generation):
+        if generation != self.generation:
+            self._entries.clear()
+            self.size = 0
+            self.generation = generation
+
+    def _estimateSize(self, results):
+        return 256 + sum(200 + len(hit.get('formatted', '')) * 2 for hit in results)
+
+    def get(self, key, generation):
+        """Return the cached results for `key`, or None.
+
+        A `generation` of None means the index can't say when it changes, so
+        nothing is cached.
+        """
+
+        self._checkGeneration(generation)
+        entry = self._entries.pop(key, None)
+        if entry is None or generation is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, generation, results):
+        """Cache `results` for `key`.
+
+        Results from any generation other than the newest one seen by `get`
+        (such as a search which started before a commit and finished after
+        it) are not cached.
+        """
+
+        if generation is None or generation != self.generation:
+            return
+        size = self._estimateSize(results)
+        if size > self.maxBytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old[0]
+        self._entries[key] = size, results
+        self.size += size
+        while self.size > self.maxBytes:
+            _, (evictedSize, _) = self._entries.popitem(last=False)
+            self.size -= evictedSize
+            self.evictions += 1
+
+    def metrics(self):
+        "Return metrics about the cache; see formatMetrics."
+        return [
+            ('elastirc_search_cache_hits_total', 'counter',
+             'Searches answered from the cache.', self.hits),
+            ('elastirc_search_cache_misses_total', 'counter',
+             'Searches not found in the cache.', self.misses),
+            ('elastirc_search_cache_evictions_total', 'counter',
+             'Results evicted to make room in the cache.', self.evictions),
+            ('elastirc_search_cache_bytes', 'gauge',
+             'Estimated size of the cached results.', self.size),
+        ]
+
+
+class SearchResults(list):
+    """The stored fields of each hit from a page of search results, in order.
+
+    Whoosh's Results can't outlive the searcher that produced them, so search
+    threads copy the hits out into one of these before closing the searcher.
+    """
+
+    def __init__(self, hits, runtime, page=None, nextPage=None):
+        list.__init__(self, hits)
+        self.runtime = runtime
+        self.page = page
+        self.nextPage = nextPage
+
+
+class ChannelMembership(object):
+    """Which nicks are in which channels, indexed both ways.
+
+    `nicks` maps each (lowercased) channel to the set of nicks in it, and
+    `channels` maps each nick to the set of channels it's in, so that a nick
+    leaving or changing only touches the channels it was actually in.
+    """
+
+    def __init__(self):
+        self.nicks = collections.defaultdict(set)
+        self.channels = {}
+
+    def add(self, channel, nick):
+        self.nicks[channel].add(nick)
+        self.channels.setdefault(nick, set()).add(channel)
+
+    def discard(self, channel, nick):
+        self.nicks[channel].discard(nick)
+        channels = self.channels.get(nick)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.channels[nick]
+
+    def channelsOf(self, nick):
+        "Return the set of channels a nick is in."
+        return self.channels.get(nick, frozenset())
+
+    def quit(self, nick):
+        "Remove a nick from every channel, returning the channels it was in."
+        channels = self.channels.pop(nick, frozenset())
+        for channel in channels:
+            self.nicks[channel].discard(nick)
+        return channels
+
+    def rename(self, oldname, newname):
+        "Rename a nick in every channel, returning the channels it's in."
+        channels = self.channels.pop(oldname, None)
+        if not channels:
+            return frozenset()
+        for channel in channels:
+            users = self.nicks[channel]
+            users.discard(oldname)
+            users.add(newname)
+        self.channels.setdefault(newname, set()).update(channels)
+        return channels
+
+
 class _IRCBase(irc.IRCClient):
     def ctcpQuery(self, user, channel, messages):
         messages = [(a.upper(), b) for a, b in messages]
@@ -110,46 +2237,91 @@ class _IRCBase(irc.IRCClient):
         pass
 
     def signedOn(self):
-        self.channelUsers = collections.defaultdict(set)
+        self.members = ChannelMembership()
         self.nickPrefixes = ''.join(prefix for prefix, _ in self.supported.getFeature('PREFIX').itervalues())
 
     def irc_RPL_NAMREPLY(self, prefix, params):
         channel = params[2].lower()
-        self.channelUsers[channel].update(nick.lstrip(self.nickPrefixes) for nick in params[3].split(' '))
+        for nick in params[3].split(' '):
+            self.members.add(channel, nick.lstrip(self.nickPrefixes))
 
     def userJoined(self, user, channel):
         nick, _, host = user.partition('!')
-        self.channelUsers[channel.lower()].add(nick)
+        self.members.add(channel.lower(), nick)
 
     def userLeft(self, user, channel):
         nick, _, host = user.partition('!')
-        self.channelUsers[channel.lower()].discard(nick)
+        self.members.discard(channel.lower(), nick)
 
     def userQuit(self, user, quitMessage):
         nick, _, host = user.partition('!')
-        for users in self.channelUsers.itervalues():
-            users.discard(nick)
+        self.members.quit(nick)
 
     def userKicked(self, kickee, channel, kicker, message):
         nick, _, host = kickee.partition('!')
-        self.channelUsers[channel.lower()].discard(nick)
+        self.members.discard(channel.lower(), nick)
 
     def userRenamed(self, oldname, newname):
-        for users in self.channelUsers.itervalues():
-            if oldname in users:
-                users.discard(oldname)
-                users.add(newname)
+        self.members.rename(oldname, newname)
+
+
+netsplitReasonRegexp = re.compile(r'^[^ ]+\.[^ ]+ [^ ]+\.[^ ]+$')
 
 
 class ElastircProtocol(_IRCBase):
+    """The bot which logs IRC channels.
+
+    If `aggregateNetsplits` is true, quits that look like netsplits are
+    collected for `netsplitWindow` seconds and logged as one document per
+    channel listing every nick that split. Likewise, nicks which rejoin a
+    channel they split from within `netjoinWindow` seconds of splitting are
+    logged together; joins to any other channel are logged as usual.
+    """
+
     sourceURL = 'https://github.com/Weasyl/elastirc'
     versionName = 'elastirc'
     versionNum = 'HEAD'
     versionEnv = 'twisted'
 
+    aggregateNetsplits = False
+    netsplitWindow = 5.0
+    netjoinWindow = 300.0
+    clock = None
+
     def signedOn(self):
         self.join(','.join(self.factory.channels))
         _IRCBase.signedOn(self)
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        self._splitQuits = collections.defaultdict(list)
+        self._splitJoins = collections.defaultdict(list)
+        self._splitNicks = {}
+        self._delayedSplitFlush = None
+
+    def connectionLost(self, reason):
+        if getattr(self, '_delayedSplitFlush', None) is not None:
+            self._delayedSplitFlush.cancel()
+            self._flushSplits()
+        _IRCBase.connectionLost(self, reason)
+
+    def _queueSplitEvent(self, events, channel, split, nick):
+        events[channel, split].append(nick)
+        if self._delayedSplitFlush is None:
+            self._delayedSplitFlush = self.clock.callLater(self.netsplitWindow, self._flushSplits)
+
+    def _flushSplits(self):
+        self._delayedSplitFlush = None
+        for kind, events in [('quits', self._splitQuits), ('rejoins', self._splitJoins)]:
+            for (channel, split), nicks in events.iteritems():
+                self.logDocument(
+                    channel, nicks=' '.join(nicks), reason=split,
+                    formatted='(-) netsplit %s (%s): %s' % (kind, split, ' '.join(nicks)))
+            events.clear()
+        expired = self.clock.seconds() - self.netjoinWindow
+        for nick, (splitAt, split, channels) in self._splitNicks.items():
+            if splitAt < expired:
+                del self._splitNicks[nick]
 
     def logDocument(self, channel, **document):
         self.factory.logDocument(channel, document)
@@ -164,7 +2336,15 @@ class ElastircProtocol(_IRCBase):
 
     def userJoined(self, user, channel):
         nick = user.partition('!')[0]
-        self.logDocument(channel, actor=nick, formatted='(-) %s joined' % (nick,))
+        split = self._splitNicks.get(nick) if self.aggregateNetsplits else None
+        if (split is not None and channel.lower() in split[2]
+                and split[0] >= self.clock.seconds() - self.netjoinWindow):
+            split[2].discard(channel.lower())
+            if not split[2]:
+                del self._splitNicks[nick]
+            self._queueSplitEvent(self._splitJoins, channel.lower(), split[1], nick)
+        else:
+            self.logDocument(channel, actor=nick, formatted='(-) %s joined' % (nick,))
         _IRCBase.userJoined(self, user, channel)
 
     def userLeft(self, user, channel):
@@ -174,11 +2354,17 @@ class ElastircProtocol(_IRCBase):
 
     def userQuit(self, user, quitMessage):
         nick = user.partition('!')[0]
-        for channel, users in self.channelUsers.iteritems():
-            if nick in users:
-                self.logDocument(
-                    channel, actor=nick, reason=quitMessage,
-                    formatted='(-) %s quit (%s)' % (nick, quitMessage))
+        if self.aggregateNetsplits and netsplitReasonRegexp.match(quitMessage):
+            channels = set(self.members.channelsOf(nick))
+            self._splitNicks[nick] = self.clock.seconds(), quitMessage, channels
+            for channel in channels:
+                self._queueSplitEvent(self._splitQuits, channel, quitMessage, nick)
+            _IRCBase.userQuit(self, user, quitMessage)
+            return
+        for channel in self.members.channelsOf(nick):
+            self.logDocument(
+                channel, actor=nick, reason=quitMessage,
+                formatted='(-) %s quit (%s)' % (nick, quitMessage))
         _IRCBase.userQuit(self, user, quitMessage)
 
     def userKicked(self, kickee, channel, kicker, message):
@@ -190,11 +2376,10 @@ class ElastircProtocol(_IRCBase):
         _IRCBase.userKicked(self, kickee, channel, kicker, message)
 
     def userRenamed(self, oldname, newname):
-        for channel, users in self.channelUsers.iteritems():
-            if oldname in users:
-                self.logDocument(
-                    channel, actor=newname, oldName=oldname,
-                    formatted='(-) %s changed nick from %s' % (newname, oldname))
+        for channel in self.members.channelsOf(oldname):
+            self.logDocument(
+                channel, actor=newname, oldName=oldname,
+                formatted='(-) %s changed nick from %s' % (newname, oldname))
         _IRCBase.userRenamed(self, oldname, newname)
 
     def topicUpdated(self, user, channel, newTopic):
@@ -215,18 +2400,40 @@ class ElastircProtocol(_IRCBase):
 class ElastircFactory(protocol.ReconnectingClientFactory):
     protocol = ElastircProtocol
     logFactory = DatestampedLogFile
+    ingestFactory = IngestGate
 
     channel = None
     channels = None
+    searchConcurrency = 4
+    searchQueueDepth = 16
+    searchFanOut = 4
+    searchCacheBytes = 16 * 1024 * 1024
+    logIndexCacheEntries = 256
+    logIndexCacheBytes = 64 * 1024 * 1024
+    adminUsers = frozenset()
 
     def __init__(self, logDir, writer, userAllowedChannels=None):
         self.logDir = logDir
         self.writer = writer
+        self.ingest = self.ingestFactory(writer)
+        self.searchPool = SearchPool(
+            self.searchConcurrency, self.searchQueueDepth, self.searchFanOut)
+        self.searchCache = SearchResultCache(self.searchCacheBytes)
+        self.logIndexes = LogLineIndexCache(
+            self.logIndexCacheEntries, self.logIndexCacheBytes)
+        self.profileResource = ElastircProfileResource()
+        self.documentsLogged = collections.Counter()
+        self.reconnects = 0
+        self.logWriteLatency = Histogram()
+        self.searchLatency = Histogram()
         self.logfiles = {}
+        self._lastSecond = self._lastTimestamp = None
         if self.channels is None:
             self.channels = self.channel,
-        self.logDirResource = static.File(self.logDir.path, defaultType='text/plain; charset=utf-8')
+        self.logDirResource = LogDirectory(self.logDir.path, defaultType='text/plain; charset=utf-8')
         self.userAllowedChannels = userAllowedChannels
+        self._webResources = {}
+        self._webResourcesFor = userAllowedChannels
 
     def getLogFile(self, channel):
         """Return the LogFile for the given channel.
@@ -242,13 +2449,45 @@ class ElastircFactory(protocol.ReconnectingClientFactory):
             if not thisLogDir.exists():
                 thisLogDir.makedirs()
             ret = self.logfiles[channel] = self.logFactory(channel, thisLogDir.path)
+            ret.writeLatency = self.logWriteLatency
         return ret
 
+    def flushLogs(self):
+        "Write out everything still buffered for any of the log files."
+        for logfile in self.logfiles.itervalues():
+            logfile.flush()
+
+    def liveLogRanges(self):
+        """Return the ranges of bytes written to each log file by this process.
+
+        This is a dict mapping log file names to (start, end) offsets, suitable
+        for a LogSyncer's `liveRanges`. Each range ends before the first
+        document the `ingest` IngestGate is still holding back (see
+        IngestGate.pendingOffsets), since those aren't indexed yet.
+        """
+
+        pending = self.ingest.pendingOffsets()
+        ret = {}
+        for logfile in self.logfiles.itervalues():
+            for name, (start, end) in logfile.liveRanges.iteritems():
+                ret[name] = start, max(start, min(end, pending.get(name, end)))
+        return ret
+
+    def takeLostLogOffsets(self):
+        """Return and forget where the documents the writer dropped were logged.
+
+        This is a dict mapping log file names to lists of offsets, suitable
+        for a LogSyncer's `lostOffsets`.
+        """
+
+        return self.ingest.takeLostOffsets()
+
     def logDocument(self, channel, document):
         """Log a document from a particular channel.
 
-        This will immediately write out the plaintext log to disk and queue up
-        the ElasticSearch item for inserting. The document can contain as many
+        This will queue up both the plaintext log line for writing to disk and
+        the document for indexing, which the `ingest` IngestGate may hold back
+        or shed under load. The document can contain as many
         keys as are relevant, but must at least contain a unicode string under
         the key `formatted`, which will be written out to the log file and
         displayed in search results.
@@ -258,37 +2497,235 @@ class ElastircFactory(protocol.ReconnectingClientFactory):
             return
         channel = unprefixedChannel(channel)
         now = datetime.datetime.now()
-        for k, v in document.iteritems():
-            document[k] = fixupMessage(v)
-        self.getLogFile(channel).write(
-            '%s %s\n' % (now.strftime(TIME_FORMAT), document['formatted'].encode('utf-8')))
+        formatted = sanitizeDocument(document)
+        second = now.replace(microsecond=0)
+        if second != self._lastSecond:
+            self._lastSecond = second
+            self._lastTimestamp = second.strftime(TIME_FORMAT)
+        document['logOffset'] = self.getLogFile(channel).write(
+            '%s %s\n' % (self._lastTimestamp, formatted), now)
         document['receivedAt'] = now
         document['channel'] = channel.decode()
-        self.writer.add_document(**document)
+        self.ingest.add_document(**document)
+        self.documentsLogged[channel] += 1
+
+    def retry(self, connector=None):
+        if self.continueTrying:
+            self.reconnects += 1
+        protocol.ReconnectingClientFactory.retry(self, connector)
+
+    def metrics(self):
+        """Return metrics about logging, indexing and searching.
+
+        See formatMetrics. This includes the metrics of the ingest gate, of
+        the writer, if it has any, and of the search pool and cache.
+        """
+
+        ret = [
+            ('elastirc_documents_logged_total', 'counter',
+             'Documents logged, by channel.',
+             dict(((('channel', channel),), count)
+                  for channel, count in self.documentsLogged.iteritems())),
+            ('elastirc_log_write_duration_seconds', 'histogram',
+             'Time taken by each write of buffered lines to a log file.',
+             self.logWriteLatency),
+            ('elastirc_irc_reconnects_total', 'counter',
+             'Attempts to reconnect to IRC.', self.reconnects),
+            ('elastirc_search_duration_seconds', 'histogram',
+             'Time taken to answer each search, including cached ones.',
+             self.searchLatency),
+        ]
+        ret.extend(self.ingest.metrics())
+        if hasattr(self.writer, 'metrics'):
+            ret.extend(self.writer.metrics())
+        ret.extend(self.searchPool.metrics())
+        ret.extend(self.searchCache.metrics())
+        return ret
+
+    def indexGeneration(self):
+        """Return the generation of the index, which changes with each commit.
 
-    def buildWebResource(self, allowedChannels=None):
+        Returns None if the writer can't tell.
+        """
+
+        generation = getattr(self.writer, 'generation', None)
+        if generation is None and hasattr(self.writer, 'latest_generation'):
+            generation = self.writer.latest_generation()
+        return generation
+
+    def searchers(self, start=None, end=None, channels=None):
+        """Return a context manager for the searchers a search needs.
+
+        `start` and `end` bound the `receivedAt` of the documents searched
+        for, and `channels` is the set of unprefixed channels searched; they
+        are used to skip shards of a sharded index which can't have any
+        matches. The context manager provides a list of searchers.
+        """
+
+        if hasattr(self.writer, 'searchersFor'):
+            return self.writer.searchersFor(start, end, channels)
+        return _singleSearcher(self.writer.searcher())
+
+    def search(self, q, page, start=None, end=None, channels=None):
+        """Fetch a SearchPage of hits for a query.
+
+        `start`, `end` and `channels` are as for `searchers`. This is called
+        in a search thread.
+        """
+
+        with self.searchers(start, end, channels) as searchers:
+            results = page.search(searchers, q, self.searchPool.map)
+        fillFromLogs(self.logDir, results)
+        return results
+
+    def buildWebResource(self, allowedChannels=None, admin=False):
         """Make a Resource that exposes logs and log search.
 
-        The plaintext logs are available under `/logs` and the search is
-        available at `/`. If `allowedChannels` is provided, search and log
-        browsing will be limited to only those channels.
+        The plaintext logs are available under `/logs`, parts of them under
+        `/view`, the search is available at `/`, and every hit of a search
+        can be exported as newline-delimited JSON from `/export`. If
+        `allowedChannels` is provided, search, export and log browsing will
+        be limited to only those channels. If `admin` is true, the reactor
+        can also be profiled at `/profile`; see ElastircProfileResource.
         """
 
         root = Resource()
         root.putChild('', ElastircSearchResource(self, allowedChannels))
         root.putChild('logs', ElastircLogsResource(self.logDirResource, allowedChannels))
+        root.putChild('view', ElastircLogViewResource(self, allowedChannels))
+        root.putChild('export', ElastircExportResource(self, allowedChannels))
+        if admin:
+            root.putChild('profile', self.profileResource)
         return root
 
+    def buildMetricsResource(self, *sources):
+        """Make a Resource that exposes metrics in the Prometheus text format.
+
+        This has the factory's metrics, and those of any other `sources`, such
+        as a WeasylAPIChecker. It shows nothing but numbers, but shouldn't be
+        served to the world all the same.
+        """
+
+        return ElastircMetricsResource((self,) + sources)
+
+    def webResourceFor(self, allowedChannels=None, admin=False):
+        """Return a Resource like buildWebResource makes, shared where possible.
+
+        One is built for each distinct set of `allowedChannels` (and `admin`)
+        and reused for every user allowed that set of channels. They're all
+        thrown away once `userAllowedChannels` is replaced with a different
+        mapping.
+        """
+
+        if self._webResourcesFor is not self.userAllowedChannels:
+            self._webResources = {}
+            self._webResourcesFor = self.userAllowedChannels
+        key = None if allowedChannels is None else frozenset(allowedChannels)
+        key = key, admin
+        ret = self._webResources.get(key)
+        if ret is None:
+            ret = self._webResources[key] = self.buildWebResource(allowedChannels, admin)
+        return ret
+
     def requestAvatar(self, username, mind, *interfaces):
         if IResource not in interfaces or self.userAllowedChannels is None:
             raise NotImplementedError()
         if not self.userAllowedChannels.get(username):
             ret = ForbiddenResource()
         else:
-            ret = self.buildWebResource(self.userAllowedChannels[username])
+            ret = self.webResourceFor(
+                self.userAllowedChannels[username], username in self.adminUsers)
         return IResource, ret, lambda: None
 
 
+def intArg(args, name, default=None):
+    "Return the integer in a request arg, or `default`."
+    try:
+        return int(args[name][0])
+    except (KeyError, IndexError, ValueError):
+        return default
+
+
+timeArgRegexp = re.compile('[0-9]{2}:[0-9]{2}:[0-9]{2}$')
+
+def timeArg(args, name):
+    "Return the time in a request arg formatted like HH:MM:SS, or None."
+    value = args.get(name, [''])[0]
+    if timeArgRegexp.match(value) is None:
+        return None
+    return value
+
+
+def dateArg(args, name):
+    "Return the date in a request arg formatted like YYYY-MM-DD, or None."
+    try:
+        return datetime.datetime.strptime(args[name][0], '%Y-%m-%d').date()
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+_queryParsers = {}
+
+def queryParserFor(field):
+    """Return a QueryParser for searching a field from the search form.
+
+    Searching for an actor also finds them among the nicks of aggregated
+    netsplit documents. Parsers are made once per field and reused.
+    """
+
+    parser = _queryParsers.get(field)
+    if parser is None:
+        if field == 'actor':
+            parser = MultifieldParser(['actor', 'nicks'], schema=whooshSchema)
+        else:
+            parser = QueryParser(field, schema=whooshSchema)
+        _queryParsers[field] = parser
+    return parser
+
+
+def parseSearchArgs(args, allowedChannels):
+    """Turn the args of a search into a query.
+
+    The args are those of the search form: `actor` and `formatted` to search
+    for, `since` and `until` dates, and any number of `channel`s, which are
+    limited to the unprefixed `allowedChannels` (all of them, if none are
+    given). Returns None if there's nothing to search for. Otherwise, returns
+    the query, the datetimes bounding the `receivedAt` searched for (either
+    may be None), the set of channels searched, and a list of (name, value)
+    args which describe the search.
+    """
+
+    channels = allowedChannels
+    if 'channel' in args:
+        channels = channels.intersection(args['channel'])
+    queryArgs = dict(
+        (k, u' '.join(v[0].decode('utf-8', 'replace').split()))
+        for k, v in args.iteritems()
+        if k in ('actor', 'formatted') and any(v))
+    queryArgs = dict((k, v) for k, v in queryArgs.iteritems() if v)
+    if not queryArgs or not channels:
+        return None
+    since, until = dateArg(args, 'since'), dateArg(args, 'until')
+
+    searchArgs = [('channel', channel) for channel in sorted(channels)]
+    searchArgs.extend((k, v.encode('utf-8')) for k, v in sorted(queryArgs.iteritems()))
+    searchArgs.extend(
+        (k, v.strftime(DATE_FORMAT)) for k, v in [('since', since), ('until', until)] if v)
+
+    start = end = None
+    terms = [
+        query.Or([query.Term('channel', channel.decode('utf-8', 'replace')) for channel in channels]),
+        query.And([queryParserFor(k).parse(v) for k, v in queryArgs.iteritems()]),
+    ]
+    if since or until:
+        if since:
+            start = datetime.datetime.combine(since, datetime.time())
+        if until:
+            end = datetime.datetime.combine(until + datetime.timedelta(days=1), datetime.time())
+        terms.append(query.DateRange('receivedAt', start, end, endexcl=True))
+    return query.And(terms), start, end, channels, searchArgs
+
+
 class ElastircSearchTemplate(template.Element):
     "A template for the search form."
 
@@ -326,39 +2763,130 @@ class ElastircSearchResultFileTemplate(template.Element):
 
     @template.renderer
     def logLines(self, request, tag):
-        "Drop in each matched line from the log file."
-        self.hits.sort(key=operator.itemgetter('receivedAt'))
+        "Drop in each matched line from the log file, linked to where it is in the log."
+        channel, logDate = self.logfile
+        viewPath = '/view/%s/%s.%s?at=%%s#hit' % (channel, channel, logDate.strftime(DATE_FORMAT))
         for result in self.hits:
+            timestamp = result['receivedAt'].strftime(TIME_FORMAT)
             yield tag.clone().fillSlots(
-                timestamp=result['receivedAt'].strftime(TIME_FORMAT),
+                timestamp=timestamp,
+                viewPath=viewPath % (timestamp,),
                 **result)
 
 
+class ElastircLogViewTemplate(template.Element):
+    "A template for showing a window of lines from a log file."
+
+    loader = template.XMLFile(FilePath('templates/log-view.xhtml'))
+
+    def __init__(self, channel, logName, window, when, context):
+        template.Element.__init__(self)
+        self.channel = channel
+        self.logName = logName
+        self.number, self.lines, self.total = window
+        self.when = when
+        self.context = context
+
+    def _viewPath(self, number):
+        return '/view/%s/%s?line=%d&context=%d' % (
+            self.channel, self.logName, number, self.context)
+
+    @template.renderer
+    def content(self, request, tag):
+        "Drop in information about the log file."
+        return tag.fillSlots(
+            logName=self.logName,
+            logPath='/logs/%s/%s' % (self.channel, self.logName))
+
+    @template.renderer
+    def earlier(self, request, tag):
+        "Drop in a link to the lines before these, if there are any."
+        if not self.lines or self.lines[0][0] <= 1:
+            return ''
+        return tag.fillSlots(viewPath=self._viewPath(self.lines[0][0] - 1 - self.context))
+
+    @template.renderer
+    def later(self, request, tag):
+        "Drop in a link to the lines after these, if there are any."
+        if not self.lines or self.lines[-1][0] >= self.total:
+            return ''
+        return tag.fillSlots(viewPath=self._viewPath(self.lines[-1][0] + 1 + self.context))
+
+    @template.renderer
+    def logLines(self, request, tag):
+        """Drop in each line, marking the ones which were asked for.
+
+        The line the window is around is preceded by an anchor named `hit`.
+        """
+        for number, line in self.lines:
+            if number == self.number:
+                yield template.tags.a(id='hit')
+            if self.when is not None:
+                hit = line[:8] == self.when
+            else:
+                hit = number == self.number
+            yield tag.clone().fillSlots(
+                lineClass='log-line hit' if hit else 'log-line',
+                anchor='L%d' % (number,),
+                anchorPath='#L%d' % (number,),
+                number=str(number),
+                line=line)
+
+
 class ElastircSearchResultsTemplate(template.Element):
     "A template for the search results page."
 
     loader = template.XMLFile(FilePath('templates/search-results.xhtml'))
 
-    def __init__(self, searchResults):
+    def __init__(self, searchResults, queryArgs=()):
         template.Element.__init__(self)
         self.searchResults = searchResults
+        self.queryArgs = queryArgs
 
     @template.renderer
     def results(self, request, tag):
-        resultsByChannel = collections.defaultdict(list)
-        for result in self.searchResults:
-            logfile = result['channel'], result['receivedAt'].date()
-            resultsByChannel[logfile].append(result)
+        """Drop in the hits, grouped by log file.
 
-        ret = []
-        for logfile, hits in resultsByChannel.iteritems():
-            ret.append(ElastircSearchResultFileTemplate(logfile, hits))
-        ret.append(tag.fillSlots(took='%0.3g' % (self.searchResults.runtime,)))
-        return ret
+        The hits are already in `receivedAt` order, so each run of hits from
+        the same log file is rendered as soon as it's reached.
+        """
+        logfileOf = lambda result: (result['channel'], result['receivedAt'].date())
+        for logfile, hits in itertools.groupby(self.searchResults, logfileOf):
+            yield ElastircSearchResultFileTemplate(logfile, list(hits))
+        page = self.searchResults.page
+        yield tag.fillSlots(
+            took='%0.3g' % (self.searchResults.runtime,),
+            page=str(page.number if page is not None else 1))
+
+    @template.renderer
+    def nextPage(self, request, tag):
+        "Drop in the form for the next page of results, if there is one."
+        if self.searchResults.nextPage is None:
+            return ''
+        return tag
+
+    @template.renderer
+    def nextPageArgs(self, request, tag):
+        "Drop in the arguments needed to request the next page of results."
+        nextPage = self.searchResults.nextPage
+        args = list(self.queryArgs) + [
+            ('page', str(nextPage.number)),
+            ('size', str(nextPage.size)),
+            ('after', nextPage.cursor()),
+        ]
+        for name, value in args:
+            yield tag.clone().fillSlots(name=name, value=value)
 
 
 class ElastircSearchResource(Resource):
-    "A Resource for searching the ElasticSearch backend."
+    """A Resource for searching the ElasticSearch backend.
+
+    Results are shown `defaultPageSize` hits at a time unless the search asks
+    for a different page size, up to `maxPageSize`.
+    """
+
+    defaultPageSize = 50
+    maxPageSize = 500
 
     def __init__(self, elastircFactory, channels=None):
         Resource.__init__(self)
@@ -368,33 +2896,277 @@ class ElastircSearchResource(Resource):
         self.channels = set(channels)
         self.unprefixedChannels = set(unprefixedChannel(channel) for channel in self.channels)
         self.template_GET = ElastircSearchTemplate(self.channels)
+        self._renderedForm = self._formETag = None
+
+    def _renderForm(self):
+        "Render the search form, which never changes, to bytes."
+        rendered = []
+        d = template.flattenString(None, self.template_GET)
+        d.addCallback(rendered.append)
+        d.addErrback(log.err, 'error while rendering the search form')
+        if not rendered:
+            return None, None
+        body = '<!DOCTYPE html>\n' + rendered[0]
+        return body, '"%s"' % (hashlib.sha1(body).hexdigest(),)
 
     def render_GET(self, request):
-        "Show the template for the search form."
+        """Show the search form.
+
+        It's rendered once and kept, and sent with an ETag so browsers need
+        not fetch it again.
+        """
+        if self._renderedForm is None:
+            self._renderedForm, self._formETag = self._renderForm()
+            if self._renderedForm is None:
+                request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+                return 'An error occurred while rendering the search form.\n'
         request.setHeader('content-type', 'text/html; charset=utf8')
-        return template.renderElement(request, self.template_GET)
+        if request.setETag(self._formETag) is http.CACHED:
+            return ''
+        return self._renderedForm
 
     def render_POST(self, request):
-        "Perform the actual search."
-        channels = self.unprefixedChannels
-        if 'channel' in request.args:
-            channels.intersection_update(request.args.pop('channel'))
-        queryArgs = dict(
-            (k, v[0].decode('utf-8', 'replace'))
-            for k, v in request.args.iteritems()
-            if k in ('actor', 'formatted') and any(v))
-        if not queryArgs or not channels:
+        """Perform the actual search.
+
+        The search itself runs in one of the factory's search threads; the
+        results are rendered once it's done.
+        """
+        started = time.time()
+        page = SearchPage.fromArgs(request.args, self.defaultPageSize, self.maxPageSize)
+        search = parseSearchArgs(request.args, self.unprefixedChannels)
+        if search is None:
             return self.render_GET(request)
+        q, start, end, channels, pageArgs = search
+
+        finished = request.notifyFinish()
+        finished.addErrback(lambda ign: None)
+        cache = self.elastircFactory.searchCache
+        generation = self.elastircFactory.indexGeneration()
+        cacheKey = tuple(pageArgs), page.number, page.size, page.after, page.skip
+        results = cache.get(cacheKey, generation)
+        if results is not None:
+            self._observeLatency(results, started)
+            self._renderResults(results, request, finished, pageArgs)
+            return server.NOT_DONE_YET
+
+        if page.after is not None and (start is None or page.after > start):
+            start = page.after
+        d = self.elastircFactory.searchPool.run(
+            self.elastircFactory.search, q, page, start, end, channels)
+        d.addCallback(self._cacheResults, cache, cacheKey, generation)
+        d.addBoth(self._observeLatency, started)
+        d.addCallback(self._renderResults, request, finished, pageArgs)
+        d.addErrback(self._searchFailed, request, finished)
+        return server.NOT_DONE_YET
+
+    def _cacheResults(self, results, cache, cacheKey, generation):
+        cache.put(cacheKey, generation, results)
+        return results
+
+    def _observeLatency(self, result, started):
+        self.elastircFactory.searchLatency.observe(time.time() - started)
+        return result
+
+    def _renderResults(self, results, request, finished, pageArgs):
+        if finished.called:
+            return
+        request.setHeader('content-type', 'text/html; charset=utf-8')
+        template.renderElement(request, ElastircSearchResultsTemplate(results, pageArgs))
 
-        q = query.And([
-            query.Or([query.Term('channel', channel.decode('utf-8', 'replace')) for channel in channels]),
-            query.And([QueryParser(k, schema=whooshSchema).parse(v) for k, v in queryArgs.iteritems()]),
-        ])
+    def _searchFailed(self, failure, request, finished):
+        if failure.check(SearchQueueFull):
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            message = 'Too many searches are running; try again shortly.\n'
+        else:
+            log.err(failure, 'error while searching')
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            message = 'An error occurred while searching.\n'
+        if finished.called:
+            return
+        request.setHeader('content-type', 'text/plain; charset=utf-8')
+        request.write(message)
+        request.finish()
 
-        request.setHeader('content-type', 'text/html; charset=utf-8')
-        with self.elastircFactory.writer.searcher() as s:
-            results = s.search(q)
-            return template.renderElement(request, ElastircSearchResultsTemplate(results))
+
+@implementer(IPushProducer)
+class SearchExport(object):
+    """Streams every hit of a search to a request as newline-delimited JSON.
+
+    Hits are fetched `pageSize` at a time in the factory's search threads,
+    each page starting from the last one's cursor. This is a streaming
+    producer for the request, and no page is fetched while it's paused, so
+    at most one page of hits is held no matter how many there are.
+    """
+
+    pageSize = 1000
+
+    def __init__(self, elastircFactory, request, q, start, end, channels):
+        self.elastircFactory = elastircFactory
+        self.request = request
+        self.q = q
+        self.start = start
+        self.end = end
+        self.channels = channels
+        self.page = SearchPage(1, self.pageSize)
+        self.exported = 0
+        self._paused = self._fetching = self._stopped = False
+
+    def beginProducing(self):
+        self.request.registerProducer(self, True)
+        self._fetch()
+
+    def _fetch(self):
+        if self._paused or self._fetching or self._stopped:
+            return
+        self._fetching = True
+        start = self.start
+        if self.page.after is not None and (start is None or self.page.after > start):
+            start = self.page.after
+        d = self.elastircFactory.searchPool.run(
+            self.elastircFactory.search, self.q, self.page, start, self.end, self.channels)
+        d.addCallback(self._write)
+        d.addErrback(self._failed)
+
+    def _write(self, results):
+        self._fetching = False
+        if self._stopped:
+            return
+        self.exported += len(results)
+        self.page = results.nextPage
+        self.request.write(''.join(
+            json.dumps(hit, default=_jsonDefault, sort_keys=True) + '\n' for hit in results))
+        if self.page is None:
+            self._finish()
+        else:
+            self._fetch()
+
+    def _failed(self, failure):
+        self._fetching = False
+        if self._stopped:
+            return
+        if failure.check(SearchQueueFull):
+            message = 'too many searches are running'
+        else:
+            log.err(failure, 'error while exporting a search')
+            message = 'an error occurred while searching'
+        # It's too late for a status code once anything has been sent, so the
+        # export ends with a line saying it's incomplete.
+        self.request.write(json.dumps({'error': message}) + '\n')
+        self._finish()
+
+    def _finish(self):
+        self._stopped = True
+        self.request.unregisterProducer()
+        self.request.finish()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._fetch()
+
+    def stopProducing(self):
+        self._stopped = True
+
+
+def _jsonDefault(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+class ElastircExportResource(Resource):
+    """Exports every hit of a search as newline-delimited JSON.
+
+    This takes the same args as the search form, by GET or POST, and streams
+    a JSON object for each hit, in `receivedAt` order; see SearchExport.
+    """
+
+    isLeaf = True
+
+    def __init__(self, elastircFactory, channels=None):
+        Resource.__init__(self)
+        self.elastircFactory = elastircFactory
+        if channels is None:
+            channels = self.elastircFactory.channels
+        self.unprefixedChannels = set(unprefixedChannel(channel) for channel in channels)
+
+    def render_GET(self, request):
+        search = parseSearchArgs(request.args, self.unprefixedChannels)
+        if search is None:
+            request.setResponseCode(http.BAD_REQUEST)
+            request.setHeader('content-type', 'text/plain; charset=utf-8')
+            return 'Nothing to search for; give an actor or formatted, in a channel you can see.\n'
+        q, start, end, channels, _ = search
+        request.setHeader('content-type', 'application/x-ndjson; charset=utf-8')
+        SearchExport(self.elastircFactory, request, q, start, end, channels).beginProducing()
+        return server.NOT_DONE_YET
+
+    render_POST = render_GET
+
+
+def acceptsGzip(request):
+    "Return True if a request's Accept-Encoding allows a gzip response."
+    for coding in (request.getHeader('accept-encoding') or '').split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if quality > 0:
+            return True
+    return False
+
+
+class CompressedLogFile(static.File):
+    """Serves a compressed log file.
+
+    Clients which accept gzip are sent the file as it is, with a
+    `Content-Encoding` saying so; anyone else gets it decompressed.
+    """
+
+    def render_GET(self, request):
+        request.setHeader('vary', 'accept-encoding')
+        if acceptsGzip(request):
+            return static.File.render_GET(self, request)
+        contentType, encoding = static.getTypeAndEncoding(
+            uncompressedLogName(self.basename()), self.contentTypes,
+            self.contentEncodings, self.defaultType)
+        request.setHeader('content-type', contentType)
+        if request.method == 'HEAD':
+            return ''
+        try:
+            infile = openLogFile(self.path)
+        except IOError:
+            return ForbiddenResource().render(request)
+        static.NoRangeStaticProducer(request, infile).start()
+        return server.NOT_DONE_YET
+
+
+class LogDirectory(static.File):
+    """Serves a directory of logs, some of which may be compressed.
+
+    A log compressed by LogCompactor is served by CompressedLogFile, both
+    under its own name and under the name it had before it was compressed.
+    """
+
+    def getChild(self, path, request):
+        try:
+            child = FilePath(self.path).child(path)
+        except InsecurePath:
+            return static.File.getChild(self, path, request)
+        if not child.exists():
+            child = child.siblingExtension(compressedLogSuffix)
+        if child.basename().endswith(compressedLogSuffix) and child.isfile():
+            return CompressedLogFile(child.path, self.defaultType)
+        return static.File.getChild(self, path, request)
 
 
 class ElastircLogsResource(Resource):
@@ -413,3 +3185,155 @@ class ElastircLogsResource(Resource):
         if not name or (self.allowed is not None and name not in self.allowed):
             return ForbiddenResource()
         return self.logDirResource.getChildWithDefault(name, request)
+
+
+class ElastircLogViewResource(Resource):
+    """Shows a window of lines from a log file.
+
+    `/view/<channel>/<log name>?at=HH:MM:SS` shows the lines around the first
+    one logged at or after that time, and `?line=N` those around line N.
+    `context` lines are shown either side, up to `maxContext`. Lines are
+    found with the factory's cached LogLineIndexes, in a thread.
+    """
+
+    isLeaf = True
+    defaultContext = 50
+    maxContext = 1000
+
+    def __init__(self, elastircFactory, allowedChannels=None):
+        Resource.__init__(self)
+        self.elastircFactory = elastircFactory
+        allowed = allowedChannels
+        if allowed is not None:
+            allowed = set(unprefixedChannel(channel) for channel in allowedChannels)
+        self.allowed = allowed
+
+    def _logPath(self, channel, logName):
+        "Return the FilePath of a log, or None if there's no such log."
+        parsed = splitLogFileName(logName)
+        if (parsed is None or uncompressedLogName(logName) != logName
+                or parsed[0] != channel.decode('utf-8', 'replace')):
+            return None
+        try:
+            logPath = self.elastircFactory.logDir.child(channel).child(logName)
+        except InsecurePath:
+            return None
+        if not logPath.exists():
+            logPath = logPath.siblingExtension(compressedLogSuffix)
+        if not logPath.isfile():
+            return None
+        return logPath
+
+    def render_GET(self, request):
+        if len(request.postpath) != 2:
+            return NoResource().render(request)
+        channel, logName = request.postpath
+        if not channel or (self.allowed is not None and channel not in self.allowed):
+            return ForbiddenResource().render(request)
+        logPath = self._logPath(channel, logName)
+        if logPath is None:
+            return NoResource().render(request)
+        when = timeArg(request.args, 'at')
+        number = intArg(request.args, 'line', 1)
+        context = min(max(intArg(request.args, 'context', self.defaultContext), 0), self.maxContext)
+
+        finished = request.notifyFinish()
+        finished.addErrback(lambda ign: None)
+        index = self.elastircFactory.logIndexes.get(logPath.path)
+        d = threads.deferToThread(index.window, number, when, context)
+        d.addCallback(self._renderWindow, request, finished, channel, logName, when, context)
+        d.addErrback(self._viewFailed, request, finished)
+        return server.NOT_DONE_YET
+
+    def _renderWindow(self, window, request, finished, channel, logName, when, context):
+        if finished.called:
+            return
+        request.setHeader('content-type', 'text/html; charset=utf-8')
+        template.renderElement(
+            request, ElastircLogViewTemplate(channel, logName, window, when, context))
+
+    def _viewFailed(self, failure, request, finished):
+        log.err(failure, 'error while reading a log')
+        if finished.called:
+            return
+        request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.setHeader('content-type', 'text/plain; charset=utf-8')
+        request.write('An error occurred while reading the log.\n')
+        request.finish()
+
+
+class ElastircProfileResource(Resource):
+    """Profiles the reactor thread for a while and shows where it spent time.
+
+    `?seconds=N` sets how long to profile for, up to `maxSeconds`. By
+    default the reactor thread's stack is sampled from another thread;
+    `?mode=cprofile` runs cProfile in the reactor thread instead, which is
+    exact but slows everything down while it runs. Only one profile runs at
+    once, and nothing is done except while one is running.
+    """
+
+    isLeaf = True
+    defaultSeconds = 10
+    maxSeconds = 120
+
+    def __init__(self, reactor=None):
+        Resource.__init__(self)
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.running = False
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; charset=utf-8')
+        if self.running:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            return 'A profile is already running; try again shortly.\n'
+        seconds = min(max(intArg(request.args, 'seconds', self.defaultSeconds), 1), self.maxSeconds)
+        self.running = True
+        if request.args.get('mode', [''])[0] == 'cprofile':
+            d = defer.Deferred()
+            profile = cProfile.Profile()
+            profile.enable()
+            self.reactor.callLater(seconds, self._stopProfile, profile, d)
+        else:
+            d = threads.deferToThread(
+                sampleStacks, threading.current_thread().ident, seconds)
+            d.addCallback(lambda result: formatStackSamples(*result))
+        finished = request.notifyFinish()
+        finished.addErrback(lambda ign: None)
+        d.addBoth(self._finished, request, finished)
+        return server.NOT_DONE_YET
+
+    def _stopProfile(self, profile, d):
+        profile.disable()
+        output = StringIO.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(50)
+        stats.sort_stats('time').print_stats(50)
+        d.callback(output.getvalue())
+
+    def _finished(self, result, request, finished):
+        self.running = False
+        if isinstance(result, Failure):
+            log.err(result, 'error while profiling')
+            result = 'An error occurred while profiling.\n'
+            if not finished.called:
+                request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        if finished.called:
+            return
+        request.write(result)
+        request.finish()
+
+
+class ElastircMetricsResource(Resource):
+    "Serves the metrics of some objects; see formatMetrics."
+
+    isLeaf = True
+
+    def __init__(self, sources):
+        Resource.__init__(self)
+        self.sources = sources
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        return formatMetrics(self.sources)
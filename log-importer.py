@@ -2,70 +2,168 @@
 # See COPYING for details.
 
 import argparse
-import datetime
+import itertools
+import multiprocessing
 import os.path
-import re
+import time
 
 import elastirc
 
+from twisted.python.filepath import FilePath
 from whoosh import index
 
 
-line_pattern = re.compile(
-    r'(?P<time>[0-9:]{8}) (?P<formatted>'
-      r'\(-\) (?P<actor>[^ ]+?) '
-        r'(?P<action>joined|parted|quit'
-        r'|was kicked by (?P<kicker>[^ ]+?)'
-        r'|changed nick from (?P<oldName>[^ ]+?)'
-        r'|changed topic to (?P<topic>.*)'
-        r'|set mode .+)'
-        r'(?: \((?P<reason>.*)\))?'
-      r'|<(?P<message_actor>[^>]+?)> (?P<message>.*)'
-      r'|\* (?P<emote_actor>[^ ]+?) (?P<emote>.*)'
-    r')'
-)
+def parseLogFile(path):
+    """Parse every line of a log file into documents.
+
+    Compressed log files are decompressed as they're read. Returns the path,
+    the number of bytes parsed, the number of lines, and the documents. This
+    is run in the worker processes when importing in parallel.
+    """
+
+    basename = os.path.basename(path)
+    channel, day = elastirc.splitLogFileName(basename)
+    docs = []
+    nLines = nBytes = 0
+    with elastirc.openLogFile(path) as infile:
+        for line in infile:
+            doc = elastirc.parseLogLine(line.decode('utf-8', 'replace'), channel, day)
+            if doc is not None:
+                doc['logOffset'] = nBytes
+                docs.append(doc)
+            nLines += 1
+            nBytes += len(line)
+    return path, nBytes, nLines, docs
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--create-index', default=False, action='store_true')
+    parser.add_argument(
+        '-m', '--shard-by-month', default=False, action='store_true',
+        help='the index is a directory of indexes, one per month')
+    parser.add_argument(
+        '--shard-by-channel', default=False, action='store_true',
+        help='the index is a directory of indexes, one per channel')
+    parser.add_argument(
+        '--slim', default=False, action='store_true',
+        help='create a slim index, which reads matched lines from the logs '
+             'instead of storing them')
+    parser.add_argument(
+        '-p', '--procs', default=1, type=int,
+        help='the number of processes to parse logs and build the index with '
+             '(a sharded index is built by one process per shard being written)')
+    parser.add_argument(
+        '--checkpoint', default=100000, type=int, metavar='LINES',
+        help='commit after each log file once this many lines are uncommitted')
+    parser.add_argument(
+        '--manifest', default=None,
+        help='where to record which logs have been imported '
+             '(default: import-manifest.json in the index directory)')
+    parser.add_argument(
+        '--sync', default=None, metavar='LOGDIR',
+        help='instead of importing whole files, index whatever has been '
+             'appended to the logs in LOGDIR since they were last imported')
+    parser.add_argument(
+        '--seed-manifest', default=None, metavar='LOGDIR',
+        help='record everything in the logs in LOGDIR as already imported, '
+             'for an index built before there was a manifest')
     parser.add_argument('index')
-    parser.add_argument('infiles', nargs='*', type=argparse.FileType('r'))
+    parser.add_argument('infiles', nargs='*')
     args = parser.parse_args()
 
-    if args.create_index:
+    schema = elastirc.slimWhooshSchema if args.slim else elastirc.whooshSchema
+    if args.shard_by_month:
+        ix = elastirc.TimeShardedIndex(FilePath(args.index), schema)
+    elif args.shard_by_channel:
+        ix = elastirc.ChannelShardedIndex(FilePath(args.index), schema)
+    elif args.create_index:
         if not os.path.exists(args.index):
             os.makedirs(args.index)
-        ix = index.create_in(args.index, elastirc.whooshSchema)
+        ix = index.create_in(args.index, schema)
     else:
         ix = index.open_dir(args.index)
+        elastirc.upgradeIndexSchema(ix)
 
-    writer = ix.writer()
+    manifestPath = args.manifest or os.path.join(args.index, 'import-manifest.json')
+    manifest = elastirc.ImportManifest(FilePath(manifestPath))
 
-    for infile in args.infiles:
-        basename = os.path.basename(infile.name)
-        print 'indexing', basename
-        channel, _, date = basename.rpartition('.')
-        channel = channel.decode('utf-8')
-        for line in infile:
-            line = line.decode('utf-8')
-            groups = line_pattern.match(line).groupdict()
-            if groups['message_actor']:
-                doc = {'actor': groups['message_actor'], 'message': groups['message']}
-            elif groups['emote_actor']:
-                doc = {'actor': groups['emote_actor'], 'message': groups['emote']}
-            else:
-                doc = {}
-                for key in ['actor', 'kicker', 'oldName', 'topic', 'reason']:
-                    if groups[key]:
-                        doc[key] = groups[key]
-            doc['formatted'] = groups['formatted']
-            doc['channel'] = channel
-            doc['receivedAt'] = datetime.datetime.strptime(
-                '%sT%s' % (date, groups['time']), '%Y-%m-%dT%H:%M:%S')
+    if args.seed_manifest is not None:
+        syncer = elastirc.LogSyncer(FilePath(args.seed_manifest), None, manifest)
+        print 'recorded %d log files as imported' % (syncer.seedManifest(),)
+        return
+
+    if args.sync is not None:
+        if not manifest.path.exists() and not ix.is_empty():
+            raise SystemExit(
+                'the index has documents but there is no manifest of what they '
+                'came from; use --seed-manifest first if it has all of the logs')
+        started = time.time()
+        syncer = elastirc.LogSyncer(FilePath(args.sync), ix.writer(), manifest)
+        nLines = syncer.sync()
+        elapsed = time.time() - started
+        print 'synced %d lines in %.1fs (%.0f lines/s)' % (
+            nLines, elapsed, nLines / elapsed if elapsed else 0)
+        return
+
+    infiles = []
+    for path in args.infiles:
+        basename = os.path.basename(path)
+        if elastirc.splitLogFileName(basename) is None:
+            print 'skipping', basename, '(not a log file)'
+        elif manifest.get(elastirc.uncompressedLogName(basename)):
+            print 'skipping', basename, '(already imported; use --sync for new lines)'
+        else:
+            infiles.append(path)
+
+    if args.procs > 1:
+        pool = multiprocessing.Pool(args.procs)
+        parsed = pool.imap(parseLogFile, infiles)
+        if isinstance(ix, elastirc.ShardedIndex):
+            # A multiprocess writer for each shard a checkpoint touches would
+            # be procs processes per shard, all at once.
+            newWriter = ix.writer
+        else:
+            newWriter = lambda: ix.writer(procs=args.procs, multisegment=True)
+    else:
+        pool = None
+        parsed = itertools.imap(parseLogFile, infiles)
+        newWriter = ix.writer
+
+    started = time.time()
+    totalLines = uncommittedLines = 0
+    uncommitted = []
+    writer = newWriter()
+
+    def checkpoint():
+        writer.commit()
+        for basename, nBytes in uncommitted:
+            manifest.set(basename, nBytes)
+        manifest.save()
+        del uncommitted[:]
+
+    for path, nBytes, nLines, docs in parsed:
+        for doc in docs:
             writer.add_document(**doc)
+        basename = os.path.basename(path)
+        uncommitted.append((elastirc.uncompressedLogName(basename), nBytes))
+        totalLines += nLines
+        uncommittedLines += nLines
+        print 'indexed %s (%d lines; %.0f lines/s overall)' % (
+            basename, nLines, totalLines / (time.time() - started))
+        if uncommittedLines >= args.checkpoint:
+            checkpoint()
+            uncommittedLines = 0
+            writer = newWriter()
 
-    writer.commit()
+    checkpoint()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+    print 'imported %d lines from %d files in %.1fs (%.0f lines/s)' % (
+        totalLines, len(infiles), elapsed, totalLines / elapsed if elapsed else 0)
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,14 @@ from zope.interface import implementer
 from twisted.cred.checkers import ICredentialsChecker
 from twisted.cred.credentials import IUsernamePassword
 from twisted.cred.error import UnauthorizedLogin
-from twisted.internet import defer, protocol
+from twisted.internet import defer, protocol, task
 from twisted.internet.error import ConnectionDone, ConnectionLost
-from twisted.web.client import ResponseDone, ResponseFailed
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone, ResponseFailed
 from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
 
+import collections
 import json
-import time
 
 
 class StringReceiver(protocol.Protocol):
@@ -20,9 +20,12 @@ class StringReceiver(protocol.Protocol):
 
     def __init__(self, byteLimit=None):
         self.bytesRemaining = byteLimit
-        self.deferred = defer.Deferred()
+        self.deferred = defer.Deferred(self._cancel)
         self._buffer = []
 
+    def _cancel(self, deferred):
+        self.transport.stopProducing()
+
     def dataReceived(self, data):
         data = data[:self.bytesRemaining]
         self._buffer.append(data)
@@ -32,6 +35,9 @@ class StringReceiver(protocol.Protocol):
                 self.transport.stopProducing()
 
     def connectionLost(self, reason):
+        if self.deferred.called:
+            # It was cancelled, which already failed it.
+            return
         if ((reason.check(ResponseFailed) and any(exn.check(ConnectionDone, ConnectionLost)
                                                   for exn in reason.value.reasons))
                 or reason.check(ResponseDone, PotentialDataLoss)):
@@ -47,26 +53,124 @@ def receive(response, receiver):
 class WeirdHTTPStatusError(Exception):
     pass
 
+
+class ResultCache(object):
+    """A bounded cache of authentication results.
+
+    Successful results are kept for `ttl` seconds and failed ones for
+    `negativeTTL` seconds; either can be None to not cache those at all. At
+    most `maxEntries` results are kept, evicting the least recently used. Every
+    `sweepInterval` seconds, expired results are removed, so the cache doesn't
+    hold on to keys which are never looked up again. Time is measured with
+    `clock`, which defaults to the reactor.
+
+    The `hits`, `misses`, `evictions`, and `expirations` attributes count what
+    the cache has done.
+    """
+
+    def __init__(self, ttl, negativeTTL=None, maxEntries=10000, sweepInterval=60, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.maxEntries = maxEntries
+        self.sweepInterval = sweepInterval
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._entries = collections.OrderedDict()
+        self._sweeper = task.LoopingCall(self.sweep)
+        self._sweeper.clock = clock
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Look up a result.
+
+        Returns a (succeeded, value) tuple, or None if there's no unexpired
+        result for `key`.
+        """
+
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        expiresAt, succeeded, value = entry
+        if expiresAt <= self.clock.seconds():
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return succeeded, value
+
+    def put(self, key, succeeded, value):
+        "Cache a result, if results like it are cached at all."
+        ttl = self.ttl if succeeded else self.negativeTTL
+        if ttl is None or not self.maxEntries:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = self.clock.seconds() + ttl, succeeded, value
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        if not self._sweeper.running:
+            self._sweeper.start(self.sweepInterval, now=False)
+
+    def sweep(self):
+        "Remove every expired result."
+        now = self.clock.seconds()
+        expired = [key for key, (expiresAt, _, _) in self._entries.iteritems() if expiresAt <= now]
+        for key in expired:
+            del self._entries[key]
+        self.expirations += len(expired)
+        if not self._entries:
+            self._sweeper.stop()
+
 @implementer(ICredentialsChecker)
 class WeasylAPIChecker(object):
     """An ICredentialsChecker implementation that queries the Weasyl API.
 
     The `agent` parameter is a twisted.web.client Agent used to make the HTTP
-    request to Weasyl. This checker only works on IUsernamePassword, where the
-    password is a Weasyl API key and the username is must match the owner of
-    the API key.
+    request to Weasyl. If it's not provided, an Agent is made which keeps
+    connections to Weasyl alive for reuse. This checker only works on
+    IUsernamePassword, where the password is a Weasyl API key and the username
+    is must match the owner of the API key.
 
     The `weasylInfoAPI` attribute is the URL to the Weasyl whoami API, which
-    returns a json blob of the API user's login name and userid.
+    returns a json blob of the API user's login name and userid. It can also
+    be passed in, e.g. to point the checker at a stub server.
+
+    At most `maxConcurrentRequests` requests are made to Weasyl at once; more
+    wait their turn. Each request fails with TimeoutError if it takes longer
+    than `requestTimeout` seconds. Concurrent checks of the same credentials
+    share a single request.
+
+    Successful logins are cached for `cacheLength` seconds and API keys Weasyl
+    rejected for `negativeCacheLength` seconds, in a ResultCache of at most
+    `maxCacheEntries` entries available as the `cache` attribute. Other
+    errors are never cached.
     """
 
     credentialInterfaces = IUsernamePassword,
     weasylInfoAPI = 'https://www.weasyl.com/api/whoami'
 
-    def __init__(self, agent, cacheLength=None):
+    def __init__(self, agent=None, cacheLength=None, negativeCacheLength=None,
+                 maxCacheEntries=10000, requestTimeout=10, maxConcurrentRequests=4,
+                 weasylInfoAPI=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if agent is None:
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = maxConcurrentRequests
+            agent = Agent(reactor, connectTimeout=requestTimeout, pool=pool)
         self.agent = agent
-        self.cacheLength = cacheLength
-        self._cache = {}
+        if weasylInfoAPI is not None:
+            self.weasylInfoAPI = weasylInfoAPI
+        self.requestTimeout = requestTimeout
+        self.cache = ResultCache(cacheLength, negativeCacheLength, maxCacheEntries, clock=reactor)
+        self._semaphore = defer.DeferredSemaphore(maxConcurrentRequests)
         self._fetching = {}
 
     def requestAvatarId(self, credentials):
@@ -77,34 +181,45 @@ class WeasylAPIChecker(object):
         deferred that will fire with the login name as returned by the API if
         it matches the provided username. The deferred will errback with
         UnauthorizedLogin if the username doesn't match or Weasyl didn't
-        recognize the API key, or with WeirdHTTPStatusError if Weasyl's API
-        returned an unexpected code.
+        recognize the API key, with WeirdHTTPStatusError if Weasyl's API
+        returned an unexpected code, or with TimeoutError if Weasyl took too
+        long to respond.
         """
 
         credKey = credentials.username, credentials.password
-        if credKey in self._cache and self.cacheLength is not None:
-            cachedAt, value = self._cache[credKey]
-            if cachedAt + self.cacheLength > time.time():
+        cached = self.cache.get(credKey)
+        if cached is not None:
+            succeeded, value = cached
+            if succeeded:
                 return defer.succeed(value)
-            del self._cache[credKey]
+            return defer.fail(UnauthorizedLogin())
 
         d = defer.Deferred()
         if credKey in self._fetching:
             self._fetching[credKey].append(d)
         else:
-            self._requestAvatarIdFromWeasyl(credentials, credKey)
             self._fetching[credKey] = [d]
+            self._requestAvatarIdFromWeasyl(credentials, credKey)
         return d
 
     def _requestAvatarIdFromWeasyl(self, credentials, credKey):
+        d = self._semaphore.run(self._fetchUserinfo, credentials.password)
+        d.addCallback(self._verifyUsername, credentials.username)
+        d.addCallbacks(self._gotResult, self._gotFailure,
+                       callbackArgs=(credKey,), errbackArgs=(credKey,))
+
+    def _fetchUserinfo(self, apiKey):
         headers = Headers()
-        headers.addRawHeader('x-weasyl-api-key', credentials.password)
+        headers.addRawHeader('x-weasyl-api-key', apiKey)
         d = self.agent.request('GET', self.weasylInfoAPI, headers)
         d.addCallback(self._trapBadStatuses)
         d.addCallback(receive, StringReceiver())
         d.addCallback(json.loads)
-        d.addCallback(self._verifyUsername, credentials.username)
-        d.addBoth(self._gotResult, credKey)
+        d.addTimeout(self.requestTimeout, self.reactor, self._timedOut)
+        return d
+
+    def _timedOut(self, result, timeout):
+        raise defer.TimeoutError('Weasyl took longer than %s seconds to respond' % (timeout,))
 
     def _trapBadStatuses(self, response):
         if response.code in (401, 403):
@@ -120,7 +235,35 @@ class WeasylAPIChecker(object):
         return login
 
     def _gotResult(self, result, credKey):
-        if self.cacheLength is not None:
-            self._cache[credKey] = time.time(), result
+        self.cache.put(credKey, True, result)
         for d in self._fetching.pop(credKey):
             d.callback(result)
+
+    def _gotFailure(self, failure, credKey):
+        if failure.check(UnauthorizedLogin):
+            self.cache.put(credKey, False, None)
+        for d in self._fetching.pop(credKey):
+            d.errback(failure)
+
+    def metrics(self):
+        """Return metrics about the checker and its cache.
+
+        These are (name, type, help, value) tuples, for
+        elastirc.formatMetrics.
+        """
+
+        cache = self.cache
+        return [
+            ('weasyl_auth_cache_hits_total', 'counter',
+             'Credentials checked from the cache.', cache.hits),
+            ('weasyl_auth_cache_misses_total', 'counter',
+             'Credentials not found in the cache.', cache.misses),
+            ('weasyl_auth_cache_expirations_total', 'counter',
+             'Cached results found to have expired.', cache.expirations),
+            ('weasyl_auth_cache_evictions_total', 'counter',
+             'Cached results evicted to make room.', cache.evictions),
+            ('weasyl_auth_cache_entries', 'gauge',
+             'Results in the cache.', len(cache)),
+            ('weasyl_auth_requests_in_progress', 'gauge',
+             'Requests to Weasyl waiting or in progress.', len(self._fetching)),
+        ]